@@ -1,10 +1,13 @@
-from flask import Blueprint, render_template, session, redirect, url_for, flash, jsonify, Response
+from flask import Blueprint, render_template, session, redirect, url_for, flash, jsonify, Response, request
 from functools import wraps
 from multiprocessing import Pool, cpu_count
+from datetime import datetime
+import base64
 import csv
 import io
+import json
 
-from db import get_db_connection
+from db import get_db_connection, fetch_from_all_nodes, scatter_gather, shard_nodes, execute_prepared
 
 admin_bp = Blueprint('admin', __name__, url_prefix='/admin')
 
@@ -31,31 +34,33 @@ def admin_required(f):
     return decorated_function
 
 #----------Display admin dashboard with user and family data----------
+DASHBOARD_FAMILIES_SQL = "SELECT DISTINCT family_id FROM users"
+DASHBOARD_USERS_SQL = "SELECT id, username, role, family_id FROM users"
+
 @admin_bp.route('/dashboard')
 @admin_required
 def admin_dashboard():
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute("SELECT DISTINCT family_id FROM users ORDER BY family_id ASC")
-    families = cur.fetchall()
-    cur.execute("SELECT id, username, role, family_id FROM users ORDER BY username ASC")
-    users = cur.fetchall()
-    cur.close()
-    conn.close()
+    # Families are spread over the shard nodes; query them all in parallel and merge
+    family_rows = fetch_from_all_nodes(DASHBOARD_FAMILIES_SQL)
+    families = sorted({row for rows in family_rows.values() for row in rows})
+    user_rows = fetch_from_all_nodes(DASHBOARD_USERS_SQL)
+    users = sorted((row for rows in user_rows.values() for row in rows), key=lambda row: row[1])
     return render_template('admin_dashboard.html', families=families, users=users)
 
 #----------Return list of users in a specific family----------
+FAMILY_MEMBERS_SQL = """
+    SELECT id, username, role
+    FROM users
+    WHERE family_id = %s
+    ORDER BY username ASC
+"""
+
 @admin_bp.route('/family_members/<int:family_id>')
 @admin_required
 def family_members(family_id):
-    conn = get_db_connection()
+    conn = get_db_connection(family_id)
     cur = conn.cursor()
-    cur.execute("""
-        SELECT id, username, role
-        FROM users
-        WHERE family_id = %s
-        ORDER BY username ASC
-    """, (family_id,))
+    cur.execute(FAMILY_MEMBERS_SQL, (family_id,))
     members = cur.fetchall()
     cur.close()
     conn.close()
@@ -63,33 +68,33 @@ def family_members(family_id):
     return jsonify(members=members_list)
 
 #----------Display expenses for a given family----------
+FAMILY_EXPENSES_SQL = """
+    SELECT e.id, u.username, e.category, e.amount, e.date, e.expense_type
+    FROM expenses e
+    JOIN users u ON e.user_id = u.id
+    WHERE e.family_id = %s
+    ORDER BY e.date DESC
+"""
+
 @admin_bp.route('/family_expenses/<int:family_id>')
 @admin_required
 def family_expenses(family_id):
-    conn = get_db_connection()
+    conn = get_db_connection(family_id)
     cur = conn.cursor()
-    cur.execute("""
-        SELECT e.id, u.username, e.category, e.amount, e.date, e.expense_type
-        FROM expenses e
-        JOIN users u ON e.user_id = u.id
-        WHERE e.family_id = %s
-        ORDER BY e.date DESC
-    """, (family_id,))
+    cur.execute(FAMILY_EXPENSES_SQL, (family_id,))
     expenses = cur.fetchall()
     cur.close()
     conn.close()
     return render_template('admin_expenses.html', expenses=expenses, family_id=family_id)
 
 #----------Export all family expenses as a CSV file----------
+EXPORT_FAMILY_IDS_SQL = "SELECT DISTINCT family_id FROM users WHERE family_id IS NOT NULL"
+
 @admin_bp.route('/export_all_csv')
 @admin_required
 def export_all_csv():
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute("SELECT DISTINCT family_id FROM users WHERE family_id IS NOT NULL ORDER BY family_id")
-    family_ids = [row[0] for row in cur.fetchall()]
-    cur.close()
-    conn.close()
+    family_rows = fetch_from_all_nodes(EXPORT_FAMILY_IDS_SQL)
+    family_ids = sorted({row[0] for rows in family_rows.values() for row in rows})
 
     with Pool(processes=min(cpu_count(), len(family_ids))) as pool:
         results = pool.map(fetch_family_expenses_csv_rows, family_ids)
@@ -115,20 +120,176 @@ def export_all_csv():
     )
 
 #----------Fetch expense rows for one family----------
+EXPORT_FAMILY_ROWS_SQL = """
+    SELECT u.family_id, u.username,
+           COALESCE(NULLIF(e.category, ''), 'NULL'),
+           COALESCE(CAST(e.amount AS TEXT), 'NULL'),
+           COALESCE(TO_CHAR(e.date, 'YYYY-MM-DD'), 'NULL'),
+           COALESCE(e.expense_type, 'NULL')
+    FROM expenses e
+    JOIN users u ON e.user_id = u.id
+    WHERE u.family_id = %s
+"""
+
 def fetch_family_expenses_csv_rows(family_id):
-    conn = get_db_connection()
+    conn = get_db_connection(family_id)
     cur = conn.cursor()
-    cur.execute("""
-        SELECT u.family_id, u.username, 
-               COALESCE(NULLIF(e.category, ''), 'NULL'),
-               COALESCE(CAST(e.amount AS TEXT), 'NULL'),
-               COALESCE(TO_CHAR(e.date, 'YYYY-MM-DD'), 'NULL'),
-               COALESCE(e.expense_type, 'NULL')
-        FROM expenses e
-        JOIN users u ON e.user_id = u.id
-        WHERE u.family_id = %s
-    """, (family_id,))
+    cur.execute(EXPORT_FAMILY_ROWS_SQL, (family_id,))
     rows = cur.fetchall()
     cur.close()
     conn.close()
     return [list(row) for row in rows]
+
+#----------Incremental export of expense changes since a cursor----------
+
+# Rows are stamped with their transaction's start time but only become
+# visible at commit, so a pull stops at the node's change_horizon: short of
+# the oldest transaction still open (however long it runs, e.g. a whole-file
+# CSV import) and of this many seconds ago. Anything later is left for the
+# next pull.
+EXPORT_SETTLE_SECONDS = 60
+EXPORT_DEFAULT_LIMIT = 10000
+EXPORT_MAX_LIMIT = 100000
+EXPORT_COLUMNS = ['op', 'id', 'family_id', 'username', 'category', 'amount', 'date',
+                  'expense_type', 'created_at', 'changed_at', 'shard']
+
+# Each branch walks its (timestamp, id) index from the cursor, and the two
+# streams are merged on (changed_at, id).
+EXPORT_CHANGES_SQL = """
+SELECT * FROM (
+    (SELECT 'upsert' AS op, e.id, e.family_id, u.username, e.category, e.amount,
+            e.date, e.expense_type, e.created_at, e.updated_at AS changed_at
+     FROM expenses e
+     LEFT JOIN users u ON e.user_id = u.id
+     WHERE (e.updated_at, e.id) > (%(since)s, %(since_id)s)
+       AND e.updated_at < %(until)s
+     ORDER BY e.updated_at, e.id
+     LIMIT %(limit)s + 1)
+    UNION ALL
+    (SELECT 'delete', t.expense_id, t.family_id, NULL, NULL, NULL,
+            NULL, NULL, NULL, t.deleted_at
+     FROM expense_tombstones t
+     WHERE (t.deleted_at, t.expense_id) > (%(since)s, %(since_id)s)
+       AND t.deleted_at < %(until)s
+     ORDER BY t.deleted_at, t.expense_id
+     LIMIT %(limit)s + 1)
+) changes
+ORDER BY changed_at, id
+LIMIT %(limit)s + 1
+"""
+
+# Each node has its own timestamps, so the cursor keeps a (changed_at, id)
+# position per node. Ids are unique across nodes, so consumers can key rows
+# by id alone. A family moved by rebalance.py shows up as upserts of the same
+# ids on its new node; the old node reports no deletes for it.
+def encode_cursor(positions):
+    raw = json.dumps({node: [changed_at.isoformat(), expense_id]
+                      for node, (changed_at, expense_id) in positions.items()})
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+def decode_cursor(cursor):
+    """Return {node: (changed_at, id)}; nodes missing from the cursor start from the beginning."""
+    positions = {node: (datetime.min, 0) for node in shard_nodes()}
+    if cursor:
+        raw = json.loads(base64.urlsafe_b64decode(cursor.encode()).decode())
+        for node, (changed_at, expense_id) in raw.items():
+            positions[node] = (datetime.fromisoformat(changed_at), int(expense_id))
+    return positions
+
+@admin_bp.route('/export_changes')
+@admin_required
+def export_changes():
+    """Expenses inserted, updated or deleted after ?cursor=, oldest first.
+
+    Returns at most ?limit= rows as ?format=csv (default) or arrow (Arrow IPC
+    stream). X-Next-Cursor is the cursor to send next time; X-Has-More says
+    whether another page is ready right away.
+    """
+    export_format = request.args.get('format', 'csv')
+    if export_format not in ('csv', 'arrow'):
+        return "format must be csv or arrow", 400
+    try:
+        positions = decode_cursor(request.args.get('cursor'))
+        limit = min(int(request.args.get('limit', EXPORT_DEFAULT_LIMIT)), EXPORT_MAX_LIMIT)
+        if limit < 1:
+            raise ValueError("limit must be positive")
+    except (ValueError, TypeError, AttributeError):
+        return "Invalid cursor or limit", 400
+
+    def fetch_changes(node):
+        since, since_id = positions.get(node, (datetime.min, 0))
+        conn = get_db_connection(node=node)
+        cur = conn.cursor()
+        execute_prepared(cur, "change_horizon", (EXPORT_SETTLE_SECONDS,))
+        until = cur.fetchone()[0]
+        # New transaction, so its snapshot includes every transaction that had
+        # finished when the horizon was read
+        conn.commit()
+        cur.execute(EXPORT_CHANGES_SQL, {
+            'since': since,
+            'since_id': since_id,
+            'until': until,
+            'limit': limit
+        })
+        rows = cur.fetchall()
+        cur.close()
+        conn.close()
+        return [row + (node,) for row in rows]
+
+    node_rows = scatter_gather(fetch_changes)
+    rows = sorted((row for rows in node_rows.values() for row in rows),
+                  key=lambda row: (row[9], row[10], row[1]))
+
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    for row in rows:
+        positions[row[10]] = (row[9], row[1])
+    headers = {
+        "X-Next-Cursor": encode_cursor(positions),
+        "X-Has-More": "true" if has_more else "false",
+    }
+
+    if export_format == 'arrow':
+        try:
+            body = changes_to_arrow(rows)
+        except ImportError:
+            return "Arrow export needs pyarrow installed on the server", 501
+        headers["Content-Disposition"] = "attachment;filename=expense_changes.arrows"
+        return Response(body, mimetype='application/vnd.apache.arrow.stream', headers=headers)
+
+    output = io.StringIO()
+    writer = csv.writer(output)
+    writer.writerow(EXPORT_COLUMNS)
+    writer.writerows(rows)
+    output.seek(0)
+    headers["Content-Disposition"] = "attachment;filename=expense_changes.csv"
+    return Response(output, mimetype='text/csv', headers=headers)
+
+def changes_to_arrow(rows):
+    import pyarrow as pa
+
+    columns = list(zip(*rows)) if rows else [[] for _ in EXPORT_COLUMNS]
+    schema = pa.schema([
+        ('op', pa.dictionary(pa.int8(), pa.string())),
+        ('id', pa.int32()),
+        ('family_id', pa.int32()),
+        ('username', pa.string()),
+        ('category', pa.dictionary(pa.int32(), pa.string())),
+        ('amount', pa.decimal128(10, 2)),
+        ('date', pa.date32()),
+        ('expense_type', pa.dictionary(pa.int32(), pa.string())),
+        ('created_at', pa.timestamp('us')),
+        ('changed_at', pa.timestamp('us')),
+        ('shard', pa.dictionary(pa.int8(), pa.string())),
+    ])
+    arrays = [
+        pa.array(column, type=field.type.value_type).dictionary_encode().cast(field.type)
+        if pa.types.is_dictionary(field.type) else pa.array(column, type=field.type)
+        for column, field in zip(columns, schema)
+    ]
+    batch = pa.record_batch(arrays, schema=schema)
+
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, schema, options=pa.ipc.IpcWriteOptions(compression='zstd')) as writer:
+        writer.write_batch(batch)
+    return sink.getvalue().to_pybytes()
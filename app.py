@@ -1,17 +1,27 @@
 from flask import Flask, render_template, request, redirect, session, url_for, flash, jsonify
-from werkzeug.security import generate_password_hash, check_password_hash
 from functools import wraps
+import os
 import random
-import io
-import csv
-from db import get_db_connection, insert_user, get_user_by_username, get_budget_categories
+from db import (get_db_connection, insert_user, get_user_by_username, update_user_password,
+                release_username, get_budget_categories, insert_expense, insert_budget,
+                fetch_prepared, run_prepared, lock_family, FamilyMoved, DatabaseBusy)
 from admin import admin_bp, is_hardcoded_admin
+import forecast
+import importer
+import passwords
 
 app = Flask(__name__)
 app.secret_key = 'COP4521'
+# Leave room for the multipart headers around the file itself
+app.config['MAX_CONTENT_LENGTH'] = importer.UPLOAD_MAX_BYTES + 64 * 1024
 
 app.register_blueprint(admin_bp)
 
+@app.before_request
+def start_import_workers():
+    # Every serving process helps drain the shared import queue
+    importer.scheduler.start()
+
 # ========== Login Required Decorator ==========
 def login_required(f):
     @wraps(f)
@@ -57,14 +67,6 @@ def register():
         password = request.form['password']
         role = request.form['role']  # 'parent' or 'child'
 
-        # Check if username already exists
-        if get_user_by_username(username):
-            flash("Username already exists.")
-            return redirect('/register')
-
-        # Hash password
-        hashed_password = generate_password_hash(password)
-
         # Determine family_id
         if role == 'parent':
             parent_option = request.form.get('parent_option')
@@ -84,8 +86,16 @@ def register():
                 flash("Missing or invalid family ID for child account.")
                 return redirect('/register')
 
-        # Insert into DB
-        insert_user(username, hashed_password, role, family_id)
+        # Hash password off-thread, then insert; a taken username comes back as None
+        try:
+            hashed_password = passwords.hash_password(password)
+        except passwords.HashingBusy as e:
+            flash(str(e))
+            return redirect('/register')
+
+        if insert_user(username, hashed_password, role, family_id) is None:
+            flash("Username already exists.")
+            return redirect('/register')
 
         flash("Registration successful! Please log in.")
         return redirect('/login')
@@ -110,7 +120,20 @@ def login():
         
         user = get_user_by_username(username)
 
-        if user and check_password_hash(user[2], password):
+        try:
+            matches, new_hash = passwords.verify_password(user[2], password) if user else (False, None)
+        except passwords.HashingBusy as e:
+            flash(str(e))
+            return render_template('login.html')
+
+        if matches:
+            if new_hash:
+                # Hash parameters changed since this password was stored. Best
+                # effort: the next login tries again if this write fails.
+                try:
+                    update_user_password(user[0], user[4], new_hash)
+                except Exception as e:
+                    print("Error rehashing password for user", user[0], ":", e)
             session['user_id'] = user[0]
             session['username'] = user[1]
             session['role'] = user[3]
@@ -135,49 +158,32 @@ def logout():
 @app.route('/accounts')
 @login_required
 def accounts():
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute("""
-        SELECT username, role
-        FROM users
-        WHERE family_id = %s
-        ORDER BY username ASC
-    """, (session['family_id'],))
-    users = cur.fetchall()
-    cur.close()
-    conn.close()
+    _, users = fetch_prepared('family_users', (session['family_id'],), family_id=session['family_id'])
     return render_template('accounts.html', users=users)
 
 # ========== Edit Accounts (Parents Only) ==========
 @app.route('/edit_accounts')
 @role_required('parent')
 def edit_accounts():
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute("""
-        SELECT username, role
-        FROM users
-        WHERE family_id = %s
-        ORDER BY username ASC
-    """, (session['family_id'],))
-    users = cur.fetchall()
-    cur.close()
-    conn.close()
+    _, users = fetch_prepared('family_users', (session['family_id'],), family_id=session['family_id'])
     return render_template('edit_accounts.html', users=users)
 
 # ========== Deleting Users(Parent Only) ==========
 
+DELETE_USER_LOOKUP_SQL = """
+    SELECT role FROM users
+    WHERE username = %s AND family_id = %s
+"""
+DELETE_USER_SQL = "DELETE FROM users WHERE username = %s"
+
 @app.route('/delete_user/<username>', methods=['POST'])
 @role_required('parent')
 def delete_user(username):
-    conn = get_db_connection()
+    conn = get_db_connection(session['family_id'])
     cur = conn.cursor()
 
     # Make sure the user is a child in the same family
-    cur.execute("""
-        SELECT role FROM users
-        WHERE username = %s AND family_id = %s
-    """, (username, session['family_id']))
+    cur.execute(DELETE_USER_LOOKUP_SQL, (username, session['family_id']))
     user = cur.fetchone()
 
     if not user:
@@ -185,9 +191,15 @@ def delete_user(username):
     elif user[0] == 'parent':
         flash("You cannot delete parent accounts.")
     else:
-        cur.execute("DELETE FROM users WHERE username = %s", (username,))
-        conn.commit()
-        flash(f"Deleted user: {username}")
+        try:
+            lock_family(cur, session['family_id'])
+            cur.execute(DELETE_USER_SQL, (username,))
+            conn.commit()
+            release_username(username)
+            flash(f"Deleted user: {username}")
+        except FamilyMoved as e:
+            conn.rollback()
+            flash(str(e))
 
     cur.close()
     conn.close()
@@ -206,56 +218,49 @@ def open_file():
             flash("Invalid file format. Please upload a CSV file.")
             return redirect('/open_file')
 
+        path = None
         try:
-            # Read CSV content
-            stream = io.StringIO(uploaded_file.stream.read().decode("UTF8"), newline=None)
-            csv_reader = csv.DictReader(stream)
-
-            conn = get_db_connection()
-            cur = conn.cursor()
-
-            # Insert each row into the expenses table
-            for row in csv_reader:
-                cur.execute("""
-                    INSERT INTO expenses (user_id, family_id, category, amount, date, expense_type)
-                    VALUES (%s, %s, %s, %s, %s, %s)
-                """, (
-                    session['user_id'],
-                    session['family_id'],
-                    row['category'],
-                    float(row['amount']),
-                    row['date'],
-                    row['expense_type']
-                ))
-
-            conn.commit()
-            cur.close()
-            conn.close()
-
-            flash("File uploaded and expenses saved successfully!")
-            return redirect('/open_expenses')
-
+            # Spool to disk instead of holding the file in worker memory,
+            # then hand it to the import workers
+            path = importer.spool_upload(uploaded_file.stream)
+            task_id, ahead = importer.scheduler.submit(session['family_id'], session['user_id'], path)
+        except (importer.UploadTooLarge, importer.ImportQueueFull) as e:
+            if path:
+                os.remove(path)
+            flash(str(e))
+            return redirect('/open_file')
         except Exception as e:
+            if path:
+                os.remove(path)
             flash(f"Error processing file: {str(e)}")
             return redirect('/open_file')
 
-    # GET request – just render upload page
-    return render_template('open_file.html')
+        if ahead:
+            flash(f"File uploaded. Import #{task_id} is queued behind {ahead} other import(s).")
+        else:
+            flash(f"File uploaded. Import #{task_id} has started.")
+        return redirect('/open_file')
+
+    # GET request – render upload page with the family's recent imports
+    imports = importer.get_recent_imports(session['family_id'])
+    return render_template('open_file.html', imports=imports, max_bytes=importer.UPLOAD_MAX_BYTES)
+
+@app.errorhandler(DatabaseBusy)
+def database_busy(e):
+    return str(e), 503
+
+@app.errorhandler(413)
+def upload_too_large(e):
+    flash(f"File is larger than {importer.UPLOAD_MAX_BYTES // (1024 * 1024)} MB.")
+    return redirect('/open_file')
 
 # ========== Show Expenses ==========
 
 @app.route('/open_expenses')
 @login_required
 def open_expenses():
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute(
-        "SELECT DISTINCT category FROM expenses WHERE family_id = %s ORDER BY category ASC",
-        (session['family_id'],)
-    )
-    categories = [row[0] for row in cur.fetchall()]
-    cur.close()
-    conn.close()
+    _, rows = fetch_prepared('expense_categories', (session['family_id'],), family_id=session['family_id'])
+    categories = [row[0] for row in rows]
     return render_template('open_expenses.html', categories=categories)  # FIXED: pass as 'categories'
  
  # ========== View Budget Page ==========
@@ -274,21 +279,10 @@ def create_table():
         category = request.form['category']
         amount = float(request.form['budget'])
 
-        conn = get_db_connection()
-        cur = conn.cursor()
-
         try:
-            cur.execute("""
-                INSERT INTO budget (family_id, category, amount)
-                VALUES (%s, %s, %s)
-            """, (session['family_id'], category, amount))
-            conn.commit()
+            insert_budget(session['family_id'], category, amount)
         except Exception as e:
-            conn.rollback()
             flash(f"Error: {str(e)}", "error")
-        finally:
-            cur.close()
-            conn.close()
 
         return redirect(url_for('open_budget'))
 
@@ -296,19 +290,27 @@ def create_table():
  
 # ========== Delete Budget Page (Parents Only)==========
 
+DELETE_BUDGET_CATEGORY_SQL = """
+    DELETE FROM budget
+    WHERE family_id = %s AND category = %s
+"""
+BUDGET_CATEGORY_LIST_SQL = """
+    SELECT category FROM budget
+    WHERE family_id = %s
+    ORDER BY category
+"""
+
 @app.route('/delete_table', methods=['GET', 'POST'])
 @role_required('parent')
 def delete_table():
-    conn = get_db_connection()
+    conn = get_db_connection(session['family_id'])
     cur = conn.cursor()
 
     if request.method == 'POST':
         category = request.form.get('department')  # Name from the dropdown
         try:
-            cur.execute("""
-                DELETE FROM budget
-                WHERE family_id = %s AND category = %s
-            """, (session['family_id'], category))
+            lock_family(cur, session['family_id'])
+            cur.execute(DELETE_BUDGET_CATEGORY_SQL, (session['family_id'], category))
             conn.commit()
             message = f"Category '{category}' deleted successfully."
         except Exception as e:
@@ -319,13 +321,9 @@ def delete_table():
             conn.close()
 
         # Re-fetch the list of categories for the refreshed page
-        conn = get_db_connection()
+        conn = get_db_connection(session['family_id'])
         cur = conn.cursor()
-        cur.execute("""
-            SELECT category FROM budget
-            WHERE family_id = %s
-            ORDER BY category
-        """, (session['family_id'],))
+        cur.execute(BUDGET_CATEGORY_LIST_SQL, (session['family_id'],))
         departments = [row[0] for row in cur.fetchall()]
         cur.close()
         conn.close()
@@ -333,11 +331,7 @@ def delete_table():
         return render_template('delete_table.html', departments=departments, message=message)
 
     # On GET, just show the list of current categories
-    cur.execute("""
-        SELECT category FROM budget
-        WHERE family_id = %s
-        ORDER BY category
-    """, (session['family_id'],))
+    cur.execute(BUDGET_CATEGORY_LIST_SQL, (session['family_id'],))
     departments = [row[0] for row in cur.fetchall()]
     cur.close()
     conn.close()
@@ -357,18 +351,10 @@ def view_category_expenses():
 
     category = data['category']
 
-    conn = get_db_connection()
-    cur = conn.cursor()
     try:
-        cur.execute("""
-            SELECT id, date, expense_type, amount
-            FROM expenses
-            WHERE family_id = %s AND category = %s
-            ORDER BY date ASC
-        """, (session['family_id'], category))
-        rows = cur.fetchall()
-
-        column_names = [desc[0] for desc in cur.description] if cur.description else []
+        column_names, rows = fetch_prepared(
+            'view_category_expenses', (session['family_id'], category), family_id=session['family_id']
+        )
         table_data = [dict(zip(column_names, row)) for row in rows]
 
         return jsonify({
@@ -378,11 +364,10 @@ def view_category_expenses():
         })
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)})
-    finally:
-        cur.close()
-        conn.close()
         
 # ========== Inline Edit Logic for Budget ==========        
+UPDATE_ROW_SQL = "UPDATE {table} SET {set_clause} WHERE id = %s"
+
 @app.route('/update_table', methods=['POST'])
 @login_required
 def update_table():
@@ -401,12 +386,13 @@ def update_table():
     cur = None
 
     try:
-        conn = get_db_connection()
+        conn = get_db_connection(session['family_id'])
         cur = conn.cursor()
+        lock_family(cur, session['family_id'])
 
         set_clause = ', '.join([f"{col} = %s" for col in updates])
         values = list(updates.values()) + [row_id]
-        cur.execute(f"UPDATE {table} SET {set_clause} WHERE id = %s", values)
+        cur.execute(UPDATE_ROW_SQL.format(table=table, set_clause=set_clause), values)
 
         conn.commit()
         return jsonify({'success': True})
@@ -430,41 +416,19 @@ def delete_expense():
     if not expense_id:
         return jsonify({'success': False, 'error': 'Missing expense ID'})
 
-    conn = None
-    cur = None
-
     try:
-        conn = get_db_connection()
-        cur = conn.cursor()
-        cur.execute("DELETE FROM expenses WHERE id = %s AND family_id = %s", (expense_id, session['family_id']))
-        conn.commit()
+        run_prepared('delete_expense', (expense_id, session['family_id']), family_id=session['family_id'])
         return jsonify({'success': True})
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)})
-    finally:
-        if cur:
-            cur.close()
-        if conn:
-            conn.close()
 
 # ========== Syncing the budget ==========
 
 @app.route('/sync_budget', methods=['POST'])
 @login_required
 def sync_budget():
-    conn = get_db_connection()
-    cur = conn.cursor()
-
     try:
-        cur.execute("""
-            SELECT id, category, amount
-            FROM budget
-            WHERE family_id = %s
-            ORDER BY category ASC
-        """, (session['family_id'],))
-        rows = cur.fetchall()
-
-        column_names = [desc[0] for desc in cur.description] if cur.description else []
+        column_names, rows = fetch_prepared('sync_budget', (session['family_id'],), family_id=session['family_id'])
         table_data = [dict(zip(column_names, row)) for row in rows]
 
         return jsonify({
@@ -474,10 +438,22 @@ def sync_budget():
         })
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)})
-    finally:
-        cur.close()
-        conn.close()
  
+# ========== Month-End Forecast for the Budget ==========
+
+@app.route('/budget_forecast', methods=['POST'])
+@login_required
+def budget_forecast():
+    try:
+        table_data = forecast.get_forecast(session['family_id'])
+        return jsonify({
+            'success': True,
+            'column_names': ['category', 'budget', 'spent', 'projected'],
+            'table_data': table_data
+        })
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)})
+
 # ========== Adding Expense With Category (Parents Only) ==========
 
 @app.route('/add_expense', methods=['GET', 'POST'])
@@ -500,18 +476,7 @@ def add_expense():
             return redirect('/add_expense')
 
         try:
-            conn = get_db_connection()
-            cur = conn.cursor()
-            cur.execute(
-                """
-                INSERT INTO expenses (user_id, family_id, category, amount, date, expense_type, added_by)
-                VALUES (%s, %s, %s, %s, %s, %s, %s)
-                """,
-                (user_id, family_id, category, amount, date, expense_type, user_id)
-            )
-            conn.commit()
-            cur.close()
-            conn.close()
+            insert_expense(user_id, family_id, category, expense_type, amount, date, user_id)
             flash("Expense added under new category!")
             return redirect('/open_expenses')
 
@@ -540,15 +505,7 @@ def submit_expense():
             flash("Missing required fields.")
             return redirect('/submit_expense')
 
-        conn = get_db_connection()
-        cur = conn.cursor()
-        cur.execute("""
-           INSERT INTO expenses (user_id, family_id, category, expense_type, amount, date, added_by)
-           VALUES (%s, %s, %s, %s, %s, %s, %s)
-        """, (user_id, family_id, category, expense_type, amount, date, user_id))  # added_by = user_id
-        conn.commit()
-        cur.close()
-        conn.close()
+        insert_expense(user_id, family_id, category, expense_type, amount, date, user_id)  # added_by = user_id
         flash("Expense submitted!")
         return redirect('/open_expenses')
 
@@ -566,36 +523,15 @@ def view_child_expenses():
     if not family_id or not user_id:
         return jsonify({'success': False, 'error': 'Missing session data'})
 
-    conn = None
-    cur = None
-
     try:
-        conn = get_db_connection()
-        cur = conn.cursor()
-
-        # Join with users to get the username to show name instead of ID
-        cur.execute("""
-            SELECT e.id, e.category, e.amount, e.expense_type, e.date, u.username AS added_by
-            FROM expenses e
-            JOIN users u ON e.added_by = u.id
-            WHERE e.family_id = %s AND e.added_by != %s
-            ORDER BY e.date DESC
-        """, (family_id, user_id))
-
-        rows = cur.fetchall()
-        column_names = [desc[0] for desc in cur.description] if cur.description else []
+        # Joins with users to get the username to show name instead of ID
+        column_names, rows = fetch_prepared('view_child_expenses', (family_id, user_id), family_id=family_id)
         table_data = [dict(zip(column_names, row)) for row in rows]
 
         return jsonify(success=True, column_names=column_names, table_data=table_data)
 
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)})
-
-    finally:
-        if cur:
-            cur.close()
-        if conn:
-            conn.close()
         
 # ========== Main ==========
 
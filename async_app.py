@@ -0,0 +1,162 @@
+# async_app.py
+#
+# Async versions of the read-only JSON endpoints, served next to the Flask app
+# by an ASGI server, e.g.:
+#
+#   hypercorn async_app:app --bind 0.0.0.0:5002
+#
+# with the reverse proxy sending these paths to it instead of app.py:
+#   POST /sync_budget, POST /view_category_expenses, POST /view_child_expenses,
+#   GET  /admin/family_members/<family_id>
+#
+# The session cookie set by the Flask login is read here unchanged, so both
+# apps must share the secret key.
+import asyncio
+from functools import wraps
+
+import asyncpg
+from quart import Quart, session, request, redirect, flash, jsonify
+
+from db import DB_POOL_MIN, DB_POOL_MAX, STATEMENTS, node_settings, node_for_family
+
+app = Quart(__name__)
+app.secret_key = 'COP4521'  # Must match app.py
+
+# ========== Connection Pool ==========
+
+@app.before_serving
+async def open_pools():
+    # One pool per shard node, opened on first use like db._get_pool, so
+    # nodes added to the shard map later are picked up too
+    app.db_pools = {}
+    app.db_pools_lock = asyncio.Lock()
+
+async def get_pool(node):
+    if node in app.db_pools:
+        return app.db_pools[node]
+    async with app.db_pools_lock:
+        if node not in app.db_pools:
+            settings = node_settings(node)
+            app.db_pools[node] = await asyncpg.create_pool(
+                database=settings["dbname"],
+                user=settings["user"],
+                password=settings["password"],
+                host=settings["host"],
+                port=int(settings["port"]),
+                min_size=DB_POOL_MIN,
+                max_size=DB_POOL_MAX
+            )
+        return app.db_pools[node]
+
+@app.after_serving
+async def close_pools():
+    for pool in app.db_pools.values():
+        await pool.close()
+
+# sql -> column names, for results that come back empty
+_column_names = {}
+
+async def fetch_table(family_id, sql, *args):
+    """Run a SELECT on family_id's node and return (column_names, rows as dicts)."""
+    pool = await get_pool(node_for_family(family_id))
+    async with pool.acquire() as conn:
+        # fetch() goes through asyncpg's per-connection statement cache, so
+        # each statement is parsed once per connection
+        rows = await conn.fetch(sql, *args)
+        if rows:
+            column_names = list(rows[0].keys())
+        elif sql in _column_names:
+            column_names = _column_names[sql]
+        else:
+            stmt = await conn.prepare(sql)
+            column_names = _column_names[sql] = [attr.name for attr in stmt.get_attributes()]
+    return column_names, [dict(row) for row in rows]
+
+# ========== Decorators ==========
+
+def login_required(f):
+    @wraps(f)
+    async def decorated_function(*args, **kwargs):
+        if 'user_id' not in session:
+            await flash("You must be logged in to view this page.")
+            return redirect('/login')  # Served by app.py
+        return await f(*args, **kwargs)
+    return decorated_function
+
+def admin_required(f):
+    @wraps(f)
+    async def decorated_function(*args, **kwargs):
+        if 'user_id' not in session:
+            await flash("Please log in first.")
+            return redirect('/login')  # Served by app.py
+        if session.get('role') != 'admin':
+            await flash("Admin access only.")
+            return redirect('/')
+        return await f(*args, **kwargs)
+    return decorated_function
+
+# ========== JSON Endpoints ==========
+
+@app.route('/view_category_expenses', methods=['POST'])
+@login_required
+async def view_category_expenses():
+    data = await request.get_json()
+
+    if not data or 'category' not in data:
+        return jsonify({'success': False, 'error': 'Missing category'})
+
+    try:
+        column_names, table_data = await fetch_table(
+            session['family_id'],
+            STATEMENTS['view_category_expenses'], session['family_id'], data['category']
+        )
+        return jsonify({
+            'success': True,
+            'column_names': column_names,
+            'table_data': table_data
+        })
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)})
+
+@app.route('/sync_budget', methods=['POST'])
+@login_required
+async def sync_budget():
+    try:
+        column_names, table_data = await fetch_table(
+            session['family_id'], STATEMENTS['sync_budget'], session['family_id']
+        )
+        return jsonify({
+            'success': True,
+            'column_names': column_names,
+            'table_data': table_data
+        })
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)})
+
+@app.route('/view_child_expenses', methods=['POST'])
+@login_required
+async def view_child_expenses():
+    family_id = session.get('family_id')
+    user_id = session.get('user_id')
+
+    if not family_id or not user_id:
+        return jsonify({'success': False, 'error': 'Missing session data'})
+
+    try:
+        column_names, table_data = await fetch_table(
+            family_id, STATEMENTS['view_child_expenses'], family_id, user_id
+        )
+        return jsonify(success=True, column_names=column_names, table_data=table_data)
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)})
+
+@app.route('/admin/family_members/<int:family_id>')
+@admin_required
+async def family_members(family_id):
+    _, members = await fetch_table(family_id, """
+        SELECT id, username, role
+        FROM users
+        WHERE family_id = $1
+        ORDER BY username ASC
+    """, family_id)
+    return jsonify(members=members)
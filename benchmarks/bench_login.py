@@ -0,0 +1,82 @@
+# benchmarks/bench_login.py
+#
+# Logins per second, before and after moving password hashing off the request
+# thread. "inline" verifies with check_password_hash on each simulated request
+# thread (the old login()); "pool" goes through passwords.verify_password. With
+# --url it instead drives POST /login on a running server.
+#
+# Usage:
+#   python benchmarks/bench_login.py [--threads 1,4,16] [--logins 200]
+#   python benchmarks/bench_login.py --url http://localhost:5001 --username alice --password secret
+import argparse
+import http.client
+import os
+import sys
+import threading
+import time
+import urllib.parse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from werkzeug.security import check_password_hash
+
+import passwords
+
+def inline_login(stored_hash, password):
+    return check_password_hash(stored_hash, password)
+
+def pool_login(stored_hash, password):
+    return passwords.verify_password(stored_hash, password)[0]
+
+def http_login(base_url, username, password):
+    url = urllib.parse.urlsplit(base_url)
+    conn = http.client.HTTPConnection(url.hostname, url.port, timeout=30)
+    body = urllib.parse.urlencode({"username": username, "password": password})
+    conn.request("POST", "/login", body, {"Content-Type": "application/x-www-form-urlencoded"})
+    response = conn.getresponse()
+    response.read()
+    conn.close()
+    return response.status == 302
+
+def measure(login, threads, logins):
+    per_thread = max(logins // threads, 1)
+    failures = []
+
+    def worker():
+        for _ in range(per_thread):
+            if not login():
+                failures.append(1)
+
+    workers = [threading.Thread(target=worker) for _ in range(threads)]
+    started = time.perf_counter()
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    return per_thread * threads / elapsed, len(failures)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--threads", default="1,4,16", help="concurrent request threads")
+    parser.add_argument("--logins", type=int, default=200)
+    parser.add_argument("--url")
+    parser.add_argument("--username")
+    parser.add_argument("--password", default="correct horse battery staple")
+    args = parser.parse_args()
+
+    if args.url:
+        cases = {"http": lambda: http_login(args.url, args.username, args.password)}
+    else:
+        stored_hash = passwords.hash_password(args.password)
+        cases = {
+            "inline": lambda: inline_login(stored_hash, args.password),
+            "pool": lambda: pool_login(stored_hash, args.password),
+        }
+        print(f"method {passwords.PASSWORD_HASH_METHOD}, {passwords.PASSWORD_HASH_WORKERS} pool workers")
+
+    print(f"{'threads':>7}  {'mode':<6} {'logins/s':>9} {'failed':>7}")
+    for threads in (int(t) for t in args.threads.split(",")):
+        for mode, login in cases.items():
+            rate, failed = measure(login, threads, args.logins)
+            print(f"{threads:>7}  {mode:<6} {rate:9.1f} {failed:>7}")
@@ -0,0 +1,90 @@
+# benchmarks/bench_prepared.py
+#
+# Compares ad-hoc execution of the hot SELECTs against the prepared registry
+# in db.py. For each query it reports the server-side planning time (from
+# EXPLAIN ANALYZE) and the client-side wall time per call, both measured on a
+# single connection per side.
+#
+# Usage: python benchmarks/bench_prepared.py <family_id> <username> <category> [iterations]
+import os
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from db import STATEMENTS, get_db_connection, get_pooled_connection, release_connection, execute_prepared
+
+PLANNING_TIME = re.compile(r"Planning Time: ([\d.]+) ms")
+
+def to_adhoc(sql):
+    # $1, $2, ... -> %s so psycopg2 can inline the parameters
+    return re.sub(r"\$\d+", "%s", sql)
+
+def planning_ms(cur, sql, params):
+    cur.execute("EXPLAIN (ANALYZE, SUMMARY) " + sql, params)
+    plan = "\n".join(row[0] for row in cur.fetchall())
+    match = PLANNING_TIME.search(plan)
+    return float(match.group(1)) if match else 0.0
+
+def bench(name, params, family_id, iterations):
+    # Both sides run on one reused connection, so the wall times compare
+    # parse/plan cost only and not connection setup
+    adhoc_sql = to_adhoc(STATEMENTS[name])
+    conn = get_db_connection(family_id)
+    cur = conn.cursor()
+    cur.execute(adhoc_sql, params)
+    cur.fetchall()
+    start = time.perf_counter()
+    for _ in range(iterations):
+        cur.execute(adhoc_sql, params)
+        cur.fetchall()
+    adhoc_wall = (time.perf_counter() - start) / iterations * 1000
+    adhoc_plan = sum(planning_ms(cur, adhoc_sql, params) for _ in range(iterations))
+    cur.close()
+    conn.rollback()
+    conn.close()
+
+    # Prepared: pooled connection, EXECUTE by name
+    conn = get_pooled_connection(family_id)
+    cur = conn.cursor()
+    execute_prepared(cur, name, params)
+    cur.fetchall()
+    start = time.perf_counter()
+    for _ in range(iterations):
+        execute_prepared(cur, name, params)
+        cur.fetchall()
+    prepared_wall = (time.perf_counter() - start) / iterations * 1000
+    placeholders = ", ".join(["%s"] * len(params))
+    prepared_plan = sum(
+        planning_ms(cur, f"EXECUTE {name} ({placeholders})", params) for _ in range(iterations)
+    )
+    cur.close()
+    conn.rollback()
+    release_connection(conn)
+
+    print(f"{name:<26} plan {adhoc_plan / iterations:8.3f} -> {prepared_plan / iterations:8.3f} ms"
+          f"   wall {adhoc_wall:8.3f} -> {prepared_wall:8.3f} ms")
+
+if __name__ == '__main__':
+    if len(sys.argv) < 4:
+        print("usage: bench_prepared.py <family_id> <username> <category> [iterations]")
+        sys.exit(1)
+
+    family_id = int(sys.argv[1])
+    username = sys.argv[2]
+    category = sys.argv[3]
+    iterations = int(sys.argv[4]) if len(sys.argv) > 4 else 200
+
+    cases = {
+        "get_user_by_username": (username,),
+        "family_users": (family_id,),
+        "expense_categories": (family_id,),
+        "view_category_expenses": (family_id, category),
+        "view_child_expenses": (family_id, 0),
+        "sync_budget": (family_id,),
+        "get_budget_categories": (family_id,),
+    }
+    print(f"{iterations} iterations per query (ad-hoc -> prepared)")
+    for name, params in cases.items():
+        bench(name, params, family_id, iterations)
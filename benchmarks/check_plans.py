@@ -0,0 +1,303 @@
+# benchmarks/check_plans.py
+#
+# Query-plan regression check. Runs EXPLAIN (ANALYZE, BUFFERS) on every query
+# the app issues against the synthetic dataset (see seed_large_dataset.py) and
+# fails if a plan:
+#   - sequentially scans expenses
+#   - uses no index (inserts and the all-families admin views are exempt)
+#   - sorts on disk
+#   - misestimates a node's row count by more than MAX_ROW_MISESTIMATE (nodes
+#     under a Limit are skipped, as they stop early)
+#   - touches more shared buffers than the query's budget
+#   - changed shape compared to plan_baseline.json (a diff is printed)
+#
+# DML is explained inside a transaction that is rolled back, so the dataset
+# is left untouched.
+#
+# Usage: python benchmarks/check_plans.py [--update-baseline]
+import difflib
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from db import STATEMENTS, get_db_connection
+import admin
+import app
+import importer
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "plan_baseline.json")
+
+MAX_ROW_MISESTIMATE = 10
+# Nodes this small are too noisy to judge estimates on
+MIN_ROWS_FOR_ESTIMATE = 100
+DEFAULT_BUFFER_BUDGET = 2000
+
+INDEX_NODES = {"Index Scan", "Index Only Scan", "Bitmap Index Scan"}
+
+# Queries issued outside the db.STATEMENTS registry.
+# name -> (sql, params(sample), options)
+ADHOC_QUERIES = {
+    # app.py
+    "delete_user_lookup": (
+        app.DELETE_USER_LOOKUP_SQL,
+        lambda s: (s["child_username"], s["family_id"]), {}),
+    "delete_user": (
+        app.DELETE_USER_SQL,
+        lambda s: (s["child_username"],), {}),
+    "update_table_expenses": (
+        app.UPDATE_ROW_SQL.format(table="expenses", set_clause="amount = %s"),
+        lambda s: (12.5, s["expense_id"]), {}),
+    "update_table_budget": (
+        app.UPDATE_ROW_SQL.format(table="budget", set_clause="amount = %s"),
+        lambda s: (12.5, s["budget_id"]), {}),
+    "delete_table": (
+        app.DELETE_BUDGET_CATEGORY_SQL,
+        lambda s: (s["family_id"], s["category"]), {}),
+    "delete_table_list": (
+        app.BUDGET_CATEGORY_LIST_SQL,
+        lambda s: (s["family_id"],), {}),
+    # admin.py; the dashboard and export_all_csv read every family by design
+    "admin_families": (
+        admin.DASHBOARD_FAMILIES_SQL,
+        lambda s: (), {"index_required": False, "buffer_budget": None}),
+    "admin_users": (
+        admin.DASHBOARD_USERS_SQL,
+        lambda s: (), {"index_required": False, "buffer_budget": None}),
+    "admin_family_members": (
+        admin.FAMILY_MEMBERS_SQL,
+        lambda s: (s["family_id"],), {}),
+    "admin_family_expenses": (
+        admin.FAMILY_EXPENSES_SQL,
+        lambda s: (s["family_id"],), {}),
+    "export_family_ids": (
+        admin.EXPORT_FAMILY_IDS_SQL,
+        lambda s: (), {"index_required": False, "buffer_budget": None}),
+    "export_family_rows": (
+        admin.EXPORT_FAMILY_ROWS_SQL,
+        lambda s: (s["family_id"],), {}),
+    "export_changes": (
+        admin.EXPORT_CHANGES_SQL,
+        lambda s: {"since": "2000-01-01", "since_id": 0, "until": "2100-01-01", "limit": 10000},
+        {"buffer_budget": None}),
+    # CSV import queue (importer.py)
+    "import_create_task": (
+        importer.CREATE_TASK_SQL,
+        lambda s: (s["family_id"], s["user_id"], "/tmp/plan_check.csv", importer.IMPORT_QUEUE_LIMIT), {}),
+    "import_set_running": (
+        importer.SET_RUNNING_SQL,
+        lambda s: ("running", s["task_id"]), {}),
+    "import_set_finished": (
+        importer.SET_FINISHED_SQL,
+        lambda s: ("done", "Imported 0 expenses.", s["task_id"]), {}),
+    "import_requeue": (
+        importer.REQUEUE_TASK_SQL,
+        lambda s: (s["task_id"],), {}),
+    "import_running_tasks": (
+        importer.RUNNING_TASKS_SQL,
+        lambda s: (), {}),
+    "import_running_count": (
+        importer.RUNNING_COUNT_SQL,
+        lambda s: (), {}),
+    "import_next_tasks": (
+        importer.NEXT_TASKS_SQL,
+        lambda s: (), {}),
+    # execute_values fills VALUES %s; one row, adapted from a tuple, stands in
+    "import_insert_rows": (
+        importer.INSERT_ROWS_SQL,
+        lambda s: ((s["user_id"], s["family_id"], s["category"], 12.5, "2025-01-01", "card"),),
+        {"index_required": False}),
+    "import_recent": (
+        importer.RECENT_IMPORTS_SQL,
+        lambda s: (s["family_id"], 5), {}),
+}
+
+# Parameters for the db.STATEMENTS registry
+STATEMENT_PARAMS = {
+    "get_user_by_username": lambda s: (s["username"],),
+    "directory_lookup": lambda s: (s["username"],),
+    "directory_claim": lambda s: ("plan_check_user", s["family_id"]),
+    "directory_release": lambda s: (s["username"],),
+    "insert_user": lambda s: ("plan_check_user", "x", "child", s["family_id"]),
+    "update_user_password": lambda s: ("x", s["user_id"]),
+    "family_users": lambda s: (s["family_id"],),
+    "insert_expense": lambda s: (s["user_id"], s["family_id"], s["category"], "card", 12.5, "2025-01-01", s["user_id"]),
+    "delete_expense": lambda s: (s["expense_id"], s["family_id"]),
+    "expense_categories": lambda s: (s["family_id"],),
+    "view_category_expenses": lambda s: (s["family_id"], s["category"]),
+    "view_child_expenses": lambda s: (s["family_id"], s["user_id"]),
+    "insert_budget": lambda s: (s["family_id"], "Plan Check", 10),
+    "sync_budget": lambda s: (s["family_id"],),
+    "get_budget_categories": lambda s: (s["family_id"],),
+    "change_horizon": lambda s: (60,),
+    "forecast_changes": lambda s: (s["family_id"], "2000-01-01"),
+    "forecast_history": lambda s: (s["family_id"], "2000-01-01", "2100-01-01", [s["category"]]),
+}
+STATEMENT_OPTIONS = {
+    "change_horizon": {"index_required": False},
+    "directory_claim": {"index_required": False},
+    "insert_user": {"index_required": False},
+    "insert_expense": {"index_required": False},
+    "insert_budget": {"index_required": False},
+}
+
+def load_sample(cur):
+    """Pick the busiest family so the checks run against the worst case."""
+    cur.execute("""
+        SELECT family_id FROM expenses
+        GROUP BY family_id ORDER BY COUNT(*) DESC LIMIT 1
+    """)
+    row = cur.fetchone()
+    if not row:
+        sys.exit("No expenses found; run benchmarks/seed_large_dataset.py first.")
+    family_id = row[0]
+
+    cur.execute("SELECT id, username, role FROM users WHERE family_id = %s ORDER BY id", (family_id,))
+    members = cur.fetchall()
+    parent = next(m for m in members if m[2] == "parent")
+    child = next((m for m in members if m[2] == "child"), members[-1])
+
+    cur.execute("SELECT id, category FROM expenses WHERE family_id = %s LIMIT 1", (family_id,))
+    expense_id, category = cur.fetchone()
+    cur.execute("SELECT id FROM budget WHERE family_id = %s LIMIT 1", (family_id,))
+    budget_row = cur.fetchone()
+    cur.execute("SELECT id FROM background_tasks WHERE family_id = %s LIMIT 1", (family_id,))
+    task_row = cur.fetchone()
+
+    return {
+        "family_id": family_id,
+        "user_id": parent[0],
+        "username": parent[1],
+        "child_username": child[1],
+        "category": category,
+        "expense_id": expense_id,
+        "budget_id": budget_row[0] if budget_row else 0,
+        "task_id": task_row[0] if task_row else 0,
+    }
+
+def explain(cur, sql, params):
+    cur.execute("EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) " + sql, params)
+    return cur.fetchone()[0][0]
+
+def explain_statement(cur, name, params):
+    # Prepared statements switch to a generic plan after five executions;
+    # force it so the check sees the plan the app settles on
+    cur.execute("SET LOCAL plan_cache_mode = force_generic_plan")
+    cur.execute(f"PREPARE plan_check_{name} AS {STATEMENTS[name]}")
+    placeholders = ", ".join(["%s"] * len(params))
+    return explain(cur, f"EXECUTE plan_check_{name} ({placeholders})", params)
+
+def walk(node):
+    yield node
+    for child in node.get("Plans", []):
+        yield from walk(child)
+
+def cut_short(root):
+    """Ids of nodes under a Limit; they stop early, so their estimates (for the full result) aren't comparable."""
+    return {id(node) for limit in walk(root) if limit["Node Type"] == "Limit"
+            for child in limit.get("Plans", []) for node in walk(child)}
+
+def plan_shape(node, depth=0):
+    label = node["Node Type"]
+    if "Relation Name" in node:
+        label += f" on {node['Relation Name']}"
+    if "Index Name" in node:
+        label += f" using {node['Index Name']}"
+    lines = ["  " * depth + label]
+    for child in node.get("Plans", []):
+        lines += plan_shape(child, depth + 1)
+    return lines
+
+def check(plan, options):
+    problems = []
+    root = plan["Plan"]
+    nodes = list(walk(root))
+    stopped_early = cut_short(root)
+
+    for node in nodes:
+        if node["Node Type"] == "Seq Scan" and node.get("Relation Name") == "expenses":
+            problems.append("sequential scan on expenses")
+        if "external" in node.get("Sort Method", "").lower():
+            problems.append(f"on-disk sort ({node['Sort Method']}, {node.get('Sort Space Used')} kB)")
+
+        actual = node.get("Actual Rows", 0) * node.get("Actual Loops", 1)
+        estimated = node.get("Plan Rows", 0) * node.get("Actual Loops", 1)
+        if id(node) not in stopped_early and max(actual, estimated) >= MIN_ROWS_FOR_ESTIMATE:
+            factor = max(actual, 1) / max(estimated, 1)
+            if factor > MAX_ROW_MISESTIMATE or factor < 1 / MAX_ROW_MISESTIMATE:
+                problems.append(
+                    f"{node['Node Type']} estimated {estimated:.0f} rows, got {actual:.0f}"
+                )
+
+    if options.get("index_required", True) and not any(node["Node Type"] in INDEX_NODES for node in nodes):
+        problems.append("no index used")
+
+    budget = options.get("buffer_budget", DEFAULT_BUFFER_BUDGET)
+    buffers = root.get("Shared Hit Blocks", 0) + root.get("Shared Read Blocks", 0)
+    if budget is not None and buffers > budget:
+        problems.append(f"{buffers} shared buffers, budget is {budget}")
+
+    return problems
+
+def all_queries(sample):
+    for name, sql in STATEMENTS.items():
+        yield name, sql, STATEMENT_PARAMS[name](sample), STATEMENT_OPTIONS.get(name, {}), True
+    for name, (sql, params, options) in ADHOC_QUERIES.items():
+        yield name, sql, params(sample), options, False
+
+def main(update_baseline):
+    conn = get_db_connection()
+    cur = conn.cursor()
+    sample = load_sample(cur)
+    conn.rollback()
+    print(f"Checking plans for family {sample['family_id']}")
+
+    shapes = {}
+    failures = 0
+    for name, sql, params, options, prepared in all_queries(sample):
+        try:
+            if prepared:
+                plan = explain_statement(cur, name, params)
+            else:
+                plan = explain(cur, sql, params)
+        finally:
+            conn.rollback()
+
+        shapes[name] = plan_shape(plan["Plan"])
+        problems = check(plan, options)
+        buffers = plan["Plan"].get("Shared Hit Blocks", 0) + plan["Plan"].get("Shared Read Blocks", 0)
+        status = "FAIL" if problems else "ok"
+        print(f"{status:<4} {name:<26} {plan['Execution Time']:9.3f} ms  {buffers:7d} buffers")
+        for problem in problems:
+            print(f"       - {problem}")
+        failures += bool(problems)
+
+    cur.close()
+    conn.close()
+
+    if update_baseline:
+        with open(BASELINE_PATH, "w") as f:
+            json.dump(shapes, f, indent=2, sort_keys=True)
+            f.write("\n")
+        print(f"Baseline written to {BASELINE_PATH}")
+    elif os.path.exists(BASELINE_PATH):
+        with open(BASELINE_PATH) as f:
+            baseline = json.load(f)
+        for name, shape in shapes.items():
+            if name not in baseline:
+                print(f"NEW  {name} (not in baseline)")
+                continue
+            diff = list(difflib.unified_diff(baseline[name], shape, "baseline", "current", lineterm=""))
+            if diff:
+                print(f"PLAN CHANGED: {name}")
+                print("\n".join("       " + line for line in diff))
+                failures += 1
+    else:
+        print("No baseline yet; run with --update-baseline and commit plan_baseline.json")
+
+    print(f"{failures} failing queries")
+    return failures
+
+if __name__ == '__main__':
+    sys.exit(1 if main("--update-baseline" in sys.argv[1:]) else 0)
@@ -0,0 +1,110 @@
+# benchmarks/load_json_endpoints.py
+#
+# Concurrent-client load test for the JSON endpoints, comparing the Flask app
+# (app.py) with the async app (async_app.py). Logs in once through the Flask
+# app, then for each concurrency level runs that many clients, each on its own
+# keep-alive connection, against both servers and prints throughput and
+# latency percentiles.
+#
+# Usage:
+#   python benchmarks/load_json_endpoints.py --username alice --password secret \
+#       --sync-url http://localhost:5001 --async-url http://localhost:5002 \
+#       --concurrency 1,10,50,100 --requests 200 --category Groceries
+import argparse
+import http.client
+import json
+import statistics
+import threading
+import time
+import urllib.parse
+
+def connect(base_url):
+    url = urllib.parse.urlsplit(base_url)
+    conn_class = http.client.HTTPSConnection if url.scheme == "https" else http.client.HTTPConnection
+    return conn_class(url.hostname, url.port, timeout=30)
+
+def login(base_url, username, password):
+    conn = connect(base_url)
+    body = urllib.parse.urlencode({"username": username, "password": password})
+    conn.request("POST", "/login", body, {"Content-Type": "application/x-www-form-urlencoded"})
+    response = conn.getresponse()
+    response.read()
+    cookie = response.getheader("Set-Cookie", "")
+    conn.close()
+    if response.status != 302 or "session=" not in cookie:
+        raise SystemExit(f"Login failed ({response.status}); check the credentials.")
+    return cookie.split(";", 1)[0]
+
+def requests_for(category):
+    # (path, body) pairs mirroring a budget page plus expense tab load
+    return [
+        ("/sync_budget", None),
+        ("/view_category_expenses", json.dumps({"category": category})),
+        ("/view_child_expenses", None),
+    ]
+
+def client(base_url, cookie, workload, count, latencies, errors, start_gate):
+    conn = connect(base_url)
+    headers = {"Cookie": cookie, "Content-Type": "application/json"}
+    start_gate.wait()
+    for i in range(count):
+        path, body = workload[i % len(workload)]
+        started = time.perf_counter()
+        try:
+            conn.request("POST", path, body, headers)
+            response = conn.getresponse()
+            payload = response.read()
+            if response.status != 200 or not json.loads(payload).get("success"):
+                errors.append(path)
+        except (OSError, http.client.HTTPException, ValueError):
+            errors.append(path)
+            conn.close()
+            conn = connect(base_url)
+        latencies.append(time.perf_counter() - started)
+    conn.close()
+
+def run(base_url, cookie, workload, clients, per_client):
+    latencies = []
+    errors = []
+    start_gate = threading.Barrier(clients + 1)
+    threads = [
+        threading.Thread(target=client, args=(base_url, cookie, workload, per_client, latencies, errors, start_gate))
+        for _ in range(clients)
+    ]
+    for thread in threads:
+        thread.start()
+    start_gate.wait()
+    started = time.perf_counter()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    p95 = latencies[int(len(latencies) * 0.95) - 1] if latencies else 0
+    return {
+        "rps": len(latencies) / elapsed,
+        "p50_ms": statistics.median(latencies) * 1000 if latencies else 0,
+        "p95_ms": p95 * 1000,
+        "errors": len(errors),
+    }
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--username", required=True)
+    parser.add_argument("--password", required=True)
+    parser.add_argument("--sync-url", default="http://localhost:5001")
+    parser.add_argument("--async-url", default="http://localhost:5002")
+    parser.add_argument("--concurrency", default="1,10,50,100")
+    parser.add_argument("--requests", type=int, default=200, help="requests per client")
+    parser.add_argument("--category", default="Groceries")
+    args = parser.parse_args()
+
+    cookie = login(args.sync_url, args.username, args.password)
+    workload = requests_for(args.category)
+
+    print(f"{'clients':>7}  {'server':<6} {'req/s':>9} {'p50 ms':>9} {'p95 ms':>9} {'errors':>7}")
+    for clients in (int(c) for c in args.concurrency.split(",")):
+        for label, base_url in (("sync", args.sync_url), ("async", args.async_url)):
+            result = run(base_url, cookie, workload, clients, args.requests)
+            print(f"{clients:>7}  {label:<6} {result['rps']:9.1f} {result['p50_ms']:9.2f}"
+                  f" {result['p95_ms']:9.2f} {result['errors']:>7}")
@@ -0,0 +1,112 @@
+# benchmarks/seed_large_dataset.py
+#
+# Loads a synthetic dataset sized like a busy deployment into the database
+# configured in .env, for plan checks and benchmarks. Existing rows are kept;
+# run schema.sql first for a clean slate.
+#
+# Usage: python benchmarks/seed_large_dataset.py [families] [expenses_per_family]
+import io
+import os
+import random
+import sys
+from datetime import date, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from db import get_db_connection
+
+CATEGORIES = ["Groceries", "Rent", "Utilities", "Transport", "Dining", "Health", "Fun", "School"]
+EXPENSE_TYPES = ["card", "cash", "transfer", "subscription"]
+# Every seeded account gets this placeholder; they are not meant to log in
+PASSWORD_HASH = "seeded-account"
+DAYS_OF_HISTORY = 400
+IMPORTS_PER_FAMILY = 5
+# Every Nth seeded expense is deleted again, leaving tombstones behind
+DELETED_EVERY = 50
+
+def copy_rows(cur, table, columns, rows):
+    buffer = io.StringIO()
+    for row in rows:
+        buffer.write("\t".join("\\N" if value is None else str(value) for value in row) + "\n")
+    buffer.seek(0)
+    cur.copy_expert(f"COPY {table} ({', '.join(columns)}) FROM STDIN", buffer)
+
+def seed(families, expenses_per_family, seed_value=4521):
+    rng = random.Random(seed_value)
+    today = date.today()
+
+    conn = get_db_connection()
+    cur = conn.cursor()
+    cur.execute("SELECT COALESCE(MAX(family_id), 100000) FROM users")
+    first_family = cur.fetchone()[0] + 1
+
+    for family_id in range(first_family, first_family + families):
+        members = [("parent", f"seed_{family_id}_p{i}") for i in range(2)]
+        members += [("child", f"seed_{family_id}_c{i}") for i in range(rng.randint(0, 3))]
+        cur.execute(
+            "INSERT INTO users (username, password, role, family_id) "
+            "SELECT * FROM UNNEST(%s::text[], %s::text[], %s::family_role[], %s::int[]) RETURNING id",
+            (
+                [name for _, name in members],
+                [PASSWORD_HASH] * len(members),
+                [role for role, _ in members],
+                [family_id] * len(members),
+            )
+        )
+        user_ids = [row[0] for row in cur.fetchall()]
+        copy_rows(cur, "user_directory", ["username", "family_id"],
+                  ((name, family_id) for _, name in members))
+
+        copy_rows(cur, "budget", ["family_id", "category", "amount"], (
+            (family_id, category, rng.randint(50, 2000))
+            for category in rng.sample(CATEGORIES, rng.randint(3, len(CATEGORIES)))
+        ))
+
+        expense_rows = []
+        for _ in range(expenses_per_family):
+            user_id = rng.choice(user_ids)
+            expense_rows.append((
+                user_id,
+                family_id,
+                rng.choice(CATEGORIES),
+                f"{rng.uniform(1, 300):.2f}",
+                today - timedelta(days=rng.randint(0, DAYS_OF_HISTORY)),
+                rng.choice(EXPENSE_TYPES),
+                user_id,
+            ))
+        copy_rows(cur, "expenses",
+                  ["user_id", "family_id", "category", "amount", "date", "expense_type", "added_by"],
+                  expense_rows)
+
+        # Finished CSV imports, as the import queue leaves them
+        copy_rows(cur, "background_tasks", ["task_name", "status", "family_id", "user_id", "detail", "ended_at"], (
+            ("csv_import", "done", family_id, rng.choice(user_ids), "Imported 0 expenses.", today)
+            for _ in range(rng.randint(0, IMPORTS_PER_FAMILY))
+        ))
+
+        if (family_id - first_family) % 500 == 499:
+            conn.commit()
+            print(f"  {family_id - first_family + 1} families loaded")
+
+    conn.commit()
+    cur.execute(
+        "DELETE FROM expenses WHERE family_id BETWEEN %s AND %s AND id %% %s = 0",
+        (first_family, first_family + families - 1, DELETED_EVERY)
+    )
+    conn.commit()
+    cur.execute("ANALYZE users")
+    cur.execute("ANALYZE budget")
+    cur.execute("ANALYZE expenses")
+    cur.execute("ANALYZE user_directory")
+    cur.execute("ANALYZE background_tasks")
+    cur.execute("ANALYZE expense_tombstones")
+    conn.commit()
+    cur.close()
+    conn.close()
+
+if __name__ == '__main__':
+    families = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    expenses_per_family = int(sys.argv[2]) if len(sys.argv) > 2 else 500
+    print(f"Seeding {families} families x {expenses_per_family} expenses")
+    seed(families, expenses_per_family)
+    print("Done")
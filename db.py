@@ -1,6 +1,13 @@
 # db.py
 import psycopg2
+import psycopg2.errors
+import psycopg2.extensions
+import psycopg2.pool
+import json
 import os
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -10,59 +17,425 @@ DB_USER = os.getenv("DB_USER")
 DB_PASSWORD = os.getenv("DB_PASSWORD")
 DB_HOST = os.getenv("DB_HOST", "localhost")
 DB_PORT = os.getenv("DB_PORT", "5432")
+DB_POOL_MIN = int(os.getenv("DB_POOL_MIN", "1"))
+DB_POOL_MAX = int(os.getenv("DB_POOL_MAX", "10"))
+# Seconds a request waits for a free pooled connection before DatabaseBusy
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "10"))
+# Optional JSON shard map (see shards.example.json). Unset means one node
+# built from the DB_* settings above.
+SHARD_MAP = os.getenv("SHARD_MAP")
+DEFAULT_NODE = "default"
 
-def get_db_connection():
-    return psycopg2.connect(
-        dbname=DB_NAME,
-        user=DB_USER,
-        password=DB_PASSWORD,
-        host=DB_HOST,
-        port=DB_PORT
-    )
+def get_db_connection(family_id=None, node=None):
+    """Open a connection to the node holding family_id, or to the directory node if None."""
+    node = node or node_for_family(family_id)
+    conn = psycopg2.connect(connection_factory=PreparedConnection, **node_settings(node))
+    conn.node = node
+    return conn
+
+# ========== SHARDING ==========
+
+# Every family-scoped row (users, budget, expenses, background_tasks) lives on
+# one node, chosen by the shard map's "families" pins or else by family_id
+# modulo "hash_nodes". The "directory" node holds user_directory, which maps
+# usernames to families for login, and serves queries with no family. Each
+# node's "id_block" says which range of ids its sequences hand out, so rows
+# keep their ids when rebalance.py moves a family between nodes.
+_shard_map = None
+_shard_map_mtime = None
+_shard_map_lock = threading.Lock()
+_scatter_executor = None
+
+def _node_settings(overrides):
+    settings = {
+        "dbname": DB_NAME,
+        "user": DB_USER,
+        "password": DB_PASSWORD,
+        "host": DB_HOST,
+        "port": DB_PORT,
+    }
+    settings.update(overrides)
+    return settings
+
+def get_shard_map():
+    """Return the current shard map, reloading SHARD_MAP whenever the file changes."""
+    global _shard_map, _shard_map_mtime
+    if not SHARD_MAP:
+        if _shard_map is None:
+            _shard_map = {
+                "nodes": {DEFAULT_NODE: _node_settings({})},
+                "id_blocks": {DEFAULT_NODE: 0},
+                "directory": DEFAULT_NODE,
+                "hash_nodes": [DEFAULT_NODE],
+                "families": {},
+            }
+        return _shard_map
+
+    mtime = os.stat(SHARD_MAP).st_mtime
+    if mtime != _shard_map_mtime:
+        with _shard_map_lock:
+            if mtime != _shard_map_mtime:
+                with open(SHARD_MAP) as f:
+                    raw = json.load(f)
+                nodes = {}
+                id_blocks = {}
+                for name, settings in raw["nodes"].items():
+                    settings = dict(settings)
+                    if "id_block" in settings:
+                        id_blocks[name] = int(settings.pop("id_block"))
+                    nodes[name] = _node_settings(settings)
+                # Required rather than defaulted to every node: adding a node
+                # would otherwise silently re-route unpinned families to it
+                hash_nodes = raw.get("hash_nodes")
+                if not hash_nodes or not set(hash_nodes) <= set(nodes):
+                    raise ValueError(f"{SHARD_MAP}: hash_nodes must list one or more of its nodes")
+                _shard_map = {
+                    "nodes": nodes,
+                    "id_blocks": id_blocks,
+                    "directory": raw.get("directory", sorted(nodes)[0]),
+                    "hash_nodes": hash_nodes,
+                    "families": {int(family_id): node for family_id, node in raw.get("families", {}).items()},
+                }
+                _shard_map_mtime = mtime
+    return _shard_map
+
+def is_sharded():
+    return len(get_shard_map()["nodes"]) > 1
+
+def shard_nodes():
+    return sorted(get_shard_map()["nodes"])
+
+def node_settings(node):
+    return get_shard_map()["nodes"][node]
+
+def node_for_family(family_id):
+    shard_map = get_shard_map()
+    if family_id is None:
+        return shard_map["directory"]
+    node = shard_map["families"].get(int(family_id))
+    if node is None:
+        hash_nodes = shard_map["hash_nodes"]
+        node = hash_nodes[int(family_id) % len(hash_nodes)]
+    return node
+
+class FamilyMoved(Exception):
+    pass
+
+# Advisory lock key space for lock_family: (FAMILY_LOCK_SPACE, family_id)
+FAMILY_LOCK_SPACE = 4522
+
+def lock_family(cur, family_id):
+    """Take family_id's write lock until cur's transaction ends, if families are sharded.
+
+    Writers share the lock; rebalance.py holds it exclusively while it moves
+    the family. Raises FamilyMoved if the move finished while we waited, so
+    the caller can roll back and redo the write on the new node.
+    """
+    if not is_sharded():
+        return
+    cur.execute("SELECT pg_advisory_xact_lock_shared(%s, %s)", (FAMILY_LOCK_SPACE, family_id))
+    if node_for_family(family_id) != cur.connection.node:
+        raise FamilyMoved(f"Family {family_id} was just moved to another server. Please try again.")
+
+def scatter_gather(fn, nodes=None):
+    """Call fn(node) on every node in parallel and return {node: result}."""
+    global _scatter_executor
+    nodes = nodes or shard_nodes()
+    if len(nodes) == 1:
+        return {nodes[0]: fn(nodes[0])}
+    if _scatter_executor is None:
+        _scatter_executor = ThreadPoolExecutor(max_workers=16, thread_name_prefix="scatter")
+    futures = {node: _scatter_executor.submit(fn, node) for node in nodes}
+    return {node: future.result() for node, future in futures.items()}
+
+def fetch_from_all_nodes(sql, params=()):
+    """Run one SELECT on every node in parallel and return {node: rows}."""
+    def fetch(node):
+        conn = get_db_connection(node=node)
+        cur = conn.cursor()
+        cur.execute(sql, params)
+        rows = cur.fetchall()
+        cur.close()
+        conn.close()
+        return rows
+    return scatter_gather(fetch)
+
+# ========== PREPARED STATEMENTS ==========
+
+# The hot query set, keyed by statement name. Each pooled connection PREPAREs
+# a statement the first time it needs it and afterwards runs EXECUTE <name>,
+# so Postgres parses and plans it once per connection instead of per request.
+STATEMENTS = {
+    "get_user_by_username": "SELECT * FROM users WHERE username = $1",
+    "directory_lookup": "SELECT family_id FROM user_directory WHERE username = $1",
+    "directory_claim": """
+        INSERT INTO user_directory (username, family_id)
+        VALUES ($1, $2)
+        ON CONFLICT (username) DO NOTHING
+        RETURNING username
+    """,
+    "directory_release": "DELETE FROM user_directory WHERE username = $1",
+    "insert_user": """
+        INSERT INTO users (username, password, role, family_id)
+        VALUES ($1, $2, $3, $4)
+        ON CONFLICT (username) DO NOTHING
+        RETURNING id
+    """,
+    "update_user_password": "UPDATE users SET password = $1 WHERE id = $2",
+    "family_users": """
+        SELECT username, role
+        FROM users
+        WHERE family_id = $1
+        ORDER BY username ASC
+    """,
+    "insert_expense": """
+        INSERT INTO expenses (user_id, family_id, category, expense_type, amount, date, added_by)
+        VALUES ($1, $2, $3, $4, $5, $6, $7)
+    """,
+    "delete_expense": "DELETE FROM expenses WHERE id = $1 AND family_id = $2",
+    "expense_categories": """
+        SELECT DISTINCT category FROM expenses WHERE family_id = $1 ORDER BY category ASC
+    """,
+    "view_category_expenses": """
+        SELECT id, date, expense_type, amount
+        FROM expenses
+        WHERE family_id = $1 AND category = $2
+        ORDER BY date ASC
+    """,
+    "view_child_expenses": """
+        SELECT e.id, e.category, e.amount, e.expense_type, e.date, u.username AS added_by
+        FROM expenses e
+        JOIN users u ON e.added_by = u.id
+        WHERE e.family_id = $1 AND e.added_by != $2
+        ORDER BY e.date DESC
+    """,
+    "insert_budget": """
+        INSERT INTO budget (family_id, category, amount)
+        VALUES ($1, $2, $3)
+    """,
+    "sync_budget": """
+        SELECT id, category, amount
+        FROM budget
+        WHERE family_id = $1
+        ORDER BY category ASC
+    """,
+    "get_budget_categories": "SELECT DISTINCT category FROM budget WHERE family_id = $1",
+    # Newest time before which every change on this node is committed: rows
+    # are stamped with their transaction's start time, so it stops short of
+    # the oldest transaction still open (and of $1 seconds ago). Other
+    # sessions' xact_start is only visible to the same database user or to
+    # pg_read_all_stats, which every app process connecting as DB_USER meets.
+    "change_horizon": """
+        SELECT LEAST(
+            LOCALTIMESTAMP - make_interval(secs => $1),
+            (SELECT MIN(xact_start)::timestamp
+             FROM pg_stat_activity
+             WHERE datname = current_database()
+               AND backend_type = 'client backend'
+               AND pid <> pg_backend_pid())
+        )
+    """,
+    "forecast_changes": """
+        SELECT category, BOOL_OR(updated_at > created_at)
+        FROM expenses
+        WHERE family_id = $1 AND updated_at >= $2
+        GROUP BY category
+        UNION ALL
+        SELECT NULL, TRUE
+        FROM expense_tombstones
+        WHERE family_id = $1 AND deleted_at >= $2
+        HAVING COUNT(*) > 0
+    """,
+    "forecast_history": """
+        SELECT category, date, amount
+        FROM expenses
+        WHERE family_id = $1 AND date >= $2 AND date < $3 AND category = ANY($4)
+    """,
+}
+
+# Registry statements that write a family's rows; they run under lock_family
+FAMILY_WRITES = {"insert_user", "update_user_password", "insert_expense", "delete_expense", "insert_budget"}
+
+class PreparedConnection(psycopg2.extensions.connection):
+    """Connection that remembers its node and which registry statements it has prepared."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prepared = set()
+        self.node = None
+
+class DatabaseBusy(Exception):
+    pass
+
+_pools = {}
+# node -> semaphore with one slot per pooled connection
+_pool_slots = {}
+_pools_lock = threading.Lock()
+
+def _get_pool(node):
+    with _pools_lock:
+        if node not in _pools:
+            _pools[node] = psycopg2.pool.ThreadedConnectionPool(
+                DB_POOL_MIN,
+                DB_POOL_MAX,
+                connection_factory=PreparedConnection,
+                **node_settings(node)
+            )
+            _pool_slots[node] = threading.BoundedSemaphore(DB_POOL_MAX)
+        return _pools[node]
+
+def get_pooled_connection(family_id=None, node=None):
+    """Take a connection from node's pool, waiting up to DB_POOL_TIMEOUT if all are in use."""
+    node = node or node_for_family(family_id)
+    pool = _get_pool(node)
+    # getconn() raises PoolError instead of waiting once DB_POOL_MAX are out
+    if not _pool_slots[node].acquire(timeout=DB_POOL_TIMEOUT):
+        raise DatabaseBusy("The server is busy. Please try again.")
+    try:
+        conn = pool.getconn()
+    except Exception:
+        _pool_slots[node].release()
+        raise
+    conn.node = node
+    return conn
+
+def release_connection(conn):
+    # The pool rolls back anything left open and discards broken connections
+    try:
+        _get_pool(conn.node).putconn(conn, close=bool(conn.closed))
+    finally:
+        _pool_slots[conn.node].release()
+
+def execute_prepared(cur, name, params=(), family_id=None):
+    """EXECUTE a registry statement on cur, preparing it on this connection first if needed.
+
+    Writes in FAMILY_WRITES take family_id's write lock first, in the same transaction.
+    """
+    conn = cur.connection
+    try:
+        _execute_by_name(cur, name, params, family_id)
+    except psycopg2.errors.FeatureNotSupported:
+        # "cached plan must not change result type": a migration changed a
+        # table under a statement prepared before it. Statements here run as
+        # their own transaction, so roll back, re-prepare and retry once.
+        conn.rollback()
+        cur.execute(f"DEALLOCATE {name}")
+        conn.prepared.discard(name)
+        _execute_by_name(cur, name, params, family_id)
+
+def _execute_by_name(cur, name, params, family_id=None):
+    conn = cur.connection
+    if family_id is not None and name in FAMILY_WRITES:
+        lock_family(cur, family_id)
+    if name not in conn.prepared:
+        cur.execute(f"PREPARE {name} AS {STATEMENTS[name]}")
+        conn.prepared.add(name)
+    if params:
+        placeholders = ", ".join(["%s"] * len(params))
+        cur.execute(f"EXECUTE {name} ({placeholders})", params)
+    else:
+        cur.execute(f"EXECUTE {name}")
+
+def fetch_prepared(name, params=(), family_id=None, node=None):
+    """Run a registry SELECT on family_id's node and return (column_names, rows)."""
+    def fetch(cur):
+        rows = cur.fetchall()
+        return [desc[0] for desc in cur.description] if cur.description else [], rows
+    return _run_on_family_node(name, params, family_id, node, fetch)
+
+def run_prepared(name, params=(), family_id=None, node=None):
+    """Run a registry INSERT/UPDATE/DELETE on family_id's node and commit it. Returns the row count."""
+    return _run_on_family_node(name, params, family_id, node, lambda cur: cur.rowcount)
+
+def _run_on_family_node(name, params, family_id, node, result):
+    # A write that waited out a rebalance of its family is redone once on the new node
+    for attempt in range(2):
+        conn = get_pooled_connection(family_id, node)
+        try:
+            cur = conn.cursor()
+            execute_prepared(cur, name, params, None if node else family_id)
+            value = result(cur)
+            cur.close()
+            conn.commit()
+            return value
+        except FamilyMoved:
+            if attempt:
+                raise
+        finally:
+            release_connection(conn)
+
+def apply_migration(path):
+    """Run a schema migration file on every node.
+
+    Running app processes need no signal: Postgres re-plans prepared
+    statements on its own after DDL, and the one case it refuses (a changed
+    result type) is re-prepared by execute_prepared's retry.
+    """
+    with open(path) as f:
+        sql = f.read()
+    for node in shard_nodes():
+        conn = get_pooled_connection(node=node)
+        try:
+            cur = conn.cursor()
+            cur.execute(sql)
+            conn.commit()
+            cur.close()
+        finally:
+            release_connection(conn)
 
 # ========== USERS ==========
 
 def insert_user(username, password, role, family_id):
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute(
-        """
-        INSERT INTO users (username, password, role, family_id)
-        VALUES (%s, %s, %s, %s)
-        """,
-        (username, password, role, family_id)
-    )
-    conn.commit()
-    cur.close()
-    conn.close()
+    """Insert a user in one round trip. Returns the new id, or None if the username is taken.
+
+    When sharded, the username is first claimed in the directory, since the
+    per-node UNIQUE constraint can't see other nodes.
+    """
+    if is_sharded():
+        _, claimed = fetch_prepared("directory_claim", (username, family_id))
+        if not claimed:
+            return None
+        try:
+            _, rows = fetch_prepared("insert_user", (username, password, role, family_id), family_id=family_id)
+        except Exception:
+            run_prepared("directory_release", (username,))
+            raise
+        if not rows:
+            run_prepared("directory_release", (username,))
+        return rows[0][0] if rows else None
+
+    _, rows = fetch_prepared("insert_user", (username, password, role, family_id))
+    return rows[0][0] if rows else None
+
+def release_username(username):
+    """Free a deleted user's name in the directory (no-op on a single node)."""
+    if is_sharded():
+        run_prepared("directory_release", (username,))
+
+def update_user_password(user_id, family_id, password):
+    run_prepared("update_user_password", (password, user_id), family_id=family_id)
 
 def get_user_by_username(username):
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute("SELECT * FROM users WHERE username = %s", (username,))
-    user = cur.fetchone()
-    cur.close()
-    conn.close()
-    return user
+    family_id = None
+    if is_sharded():
+        _, rows = fetch_prepared("directory_lookup", (username,))
+        if not rows:
+            return None
+        family_id = rows[0][0]
+    _, rows = fetch_prepared("get_user_by_username", (username,), family_id=family_id)
+    return rows[0] if rows else None
 
 # ========== EXPENSES ==========
 
 def insert_expense(user_id, family_id, category, expense_type, amount, date, added_by):
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute(
-        """
-        INSERT INTO expenses (user_id, family_id, category, expense_type, amount, date, added_by)
-        VALUES (%s, %s, %s, %s, %s, %s, %s)
-        """,
-        (user_id, family_id, category, expense_type, amount, date, added_by)
+    run_prepared(
+        "insert_expense",
+        (user_id, family_id, category, expense_type, amount, date, added_by),
+        family_id=family_id
     )
-    conn.commit()
-    cur.close()
-    conn.close()
 
 def get_expenses_by_family(family_id):
-    conn = get_db_connection()
+    conn = get_db_connection(family_id)
     cur = conn.cursor()
     cur.execute("SELECT * FROM expenses WHERE family_id = %s", (family_id,))
     rows = cur.fetchall()
@@ -73,21 +446,10 @@ def get_expenses_by_family(family_id):
 # ========== BUDGET ==========
 
 def insert_budget(family_id, category, amount):
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute(
-        """
-        INSERT INTO budget (family_id, category, amount)
-        VALUES (%s, %s, %s)
-        """,
-        (family_id, category, amount)
-    )
-    conn.commit()
-    cur.close()
-    conn.close()
+    run_prepared("insert_budget", (family_id, category, amount), family_id=family_id)
 
 def get_budgets_by_family(family_id):
-    conn = get_db_connection()
+    conn = get_db_connection(family_id)
     cur = conn.cursor()
     cur.execute("SELECT * FROM budget WHERE family_id = %s", (family_id,))
     rows = cur.fetchall()
@@ -97,13 +459,16 @@ def get_budgets_by_family(family_id):
 
 def get_budget_categories(family_id):
     try:
-        conn = get_db_connection()
-        cur = conn.cursor()
-        cur.execute("SELECT DISTINCT category FROM budget WHERE family_id = %s", (family_id,))
-        categories = [row[0] for row in cur.fetchall()]
-        cur.close()
-        conn.close()
-        return categories
+        _, rows = fetch_prepared("get_budget_categories", (family_id,), family_id=family_id)
+        return [row[0] for row in rows]
     except Exception as e:
         print("Error fetching budget categories:", e)
-        return []
\ No newline at end of file
+        return []
+
+# ========== Main ==========
+
+if __name__ == '__main__':
+    # python db.py migrations/001_example.sql [...]
+    for migration_path in sys.argv[1:]:
+        apply_migration(migration_path)
+        print("Applied", migration_path)
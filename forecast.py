@@ -0,0 +1,134 @@
+# forecast.py
+import calendar
+import threading
+from datetime import date, datetime, timedelta
+
+import numpy as np
+
+from db import fetch_prepared
+
+HISTORY_MONTHS = 6
+
+# family_id -> {"day": date, "last_run": datetime, "categories": {category: (spent, projected)}}
+# Each app process keeps its own cache; edits made through any process are
+# picked up from expenses.updated_at and expense_tombstones (see _changes).
+# Every change stamped before last_run is reflected in categories.
+_cache = {}
+# family_id -> lock held while that family's entry is refreshed
+_family_locks = {}
+_lock = threading.Lock()
+
+# ========== Public API ==========
+
+def get_forecast(family_id):
+    """Return one row per budget category with month-to-date and projected month-end spend."""
+    _, budget_rows = fetch_prepared("sync_budget", (family_id,), family_id=family_id)
+    budgets = {}
+    for _, category, amount in budget_rows:
+        if category is None:
+            continue
+        budgets[category] = budgets.get(category, 0.0) + float(amount or 0)
+
+    today = date.today()
+    with _family_lock(family_id):
+        entry = _cache.get(family_id)
+        since = entry["last_run"] if entry else datetime.min
+        touched, edited, until = _changes(family_id, since)
+        if entry is None or entry["day"] != today or edited:
+            # Projections depend on the day of month, and an edit or delete can
+            # move spend out of a category, so either means a full run
+            entry = {"day": today, "last_run": since, "categories": {}}
+            _cache[family_id] = entry
+
+        # A category whose budget was removed gets no new rows projected, so
+        # its cached spend would be stale if the budget came back
+        for category in set(entry["categories"]) - set(budgets):
+            del entry["categories"][category]
+        stale = (touched | (set(budgets) - set(entry["categories"]))) & set(budgets)
+        if stale:
+            entry["categories"].update(_project(family_id, sorted(stale), today))
+        entry["last_run"] = until
+        projections = dict(entry["categories"])
+
+    rows = []
+    for category in sorted(budgets):
+        spent, projected = projections.get(category, (0.0, 0.0))
+        rows.append({
+            "category": category,
+            "budget": round(budgets[category], 2),
+            "spent": round(spent, 2),
+            "projected": round(projected, 2),
+            "over_budget": projected > budgets[category],
+        })
+    return rows
+
+# ========== Internals ==========
+
+def _family_lock(family_id):
+    with _lock:
+        return _family_locks.setdefault(family_id, threading.Lock())
+
+def _changes(family_id, since):
+    """Return (categories with new rows, whether any row was edited or deleted, until).
+
+    Covers changes stamped at or after since. until is the node's
+    change_horizon, read first: everything stamped before it is committed,
+    however long its transaction ran (e.g. a whole-file import), so the next
+    call starts there. Later rows already visible are seen again then, which
+    only repeats their projection.
+    """
+    _, rows = fetch_prepared("change_horizon", (0,), family_id=family_id)
+    until = max(rows[0][0], since)
+    _, rows = fetch_prepared("forecast_changes", (family_id, since), family_id=family_id)
+    touched = {row[0] for row in rows if row[0] is not None}
+    edited = any(row[1] for row in rows)
+    return touched, edited, until
+
+def _month_start(year, month, offset):
+    index = year * 12 + (month - 1) - offset
+    return date(index // 12, index % 12 + 1, 1)
+
+def _project(family_id, categories, today):
+    """Project month-end spend for the given categories in one vectorized pass.
+
+    Builds a (category, month, day) cube of daily spend over the history
+    window. Projected = spent so far this month + the average amount the
+    category historically spent after today's day of month. Categories
+    with no history fall back to a linear run rate.
+    """
+    first = _month_start(today.year, today.month, HISTORY_MONTHS)
+    _, rows = fetch_prepared(
+        "forecast_history",
+        (family_id, first, today + timedelta(days=1), list(categories)),
+        family_id=family_id
+    )
+
+    index = {category: i for i, category in enumerate(categories)}
+    daily = np.zeros((len(categories), HISTORY_MONTHS + 1, 31))
+    if rows:
+        cat_idx = np.array([index[row[0]] for row in rows])
+        month_idx = np.array([(row[1].year - first.year) * 12 + row[1].month - first.month for row in rows])
+        day_idx = np.array([row[1].day - 1 for row in rows])
+        amounts = np.array([float(row[2] or 0) for row in rows])
+        np.add.at(daily, (cat_idx, month_idx, day_idx), amounts)
+
+    cumulative = daily.cumsum(axis=2)
+    d = today.day - 1
+    spent = cumulative[:, -1, d]
+
+    past_totals = cumulative[:, :-1, -1]
+    past_remaining = past_totals - cumulative[:, :-1, d]
+    active_months = (past_totals > 0).sum(axis=1)
+    remaining = np.divide(
+        past_remaining.sum(axis=1), active_months,
+        out=np.zeros(len(categories)), where=active_months > 0
+    )
+
+    days_in_month = calendar.monthrange(today.year, today.month)[1]
+    run_rate = spent * days_in_month / today.day
+    projected = np.where(active_months > 0, spent + remaining, run_rate)
+
+    return {
+        category: (float(spent[i]), float(projected[i]))
+        for category, i in index.items()
+    }
@@ -0,0 +1,355 @@
+# importer.py
+import csv
+import os
+import select
+import tempfile
+import threading
+import time
+
+from psycopg2.extras import execute_values
+
+from db import FAMILY_LOCK_SPACE, get_db_connection, is_sharded, lock_family, node_for_family, shard_nodes
+
+UPLOAD_MAX_BYTES = int(os.getenv("UPLOAD_MAX_BYTES", str(10 * 1024 * 1024)))
+# Must be one directory shared by every app process that runs imports, since
+# any of them may claim a queued file. None -> system temp dir.
+UPLOAD_SPOOL_DIR = os.getenv("UPLOAD_SPOOL_DIR") or None
+# Worker threads per app process
+IMPORT_WORKERS = int(os.getenv("IMPORT_WORKERS", "2"))
+# Imports running at once on each database node, across all app processes
+IMPORT_NODE_LIMIT = int(os.getenv("IMPORT_NODE_LIMIT", "2"))
+# Queued imports per node; uploads beyond this are refused
+IMPORT_QUEUE_LIMIT = int(os.getenv("IMPORT_QUEUE_LIMIT", "50"))
+# Workers wake on NOTIFY; this is only how often they look for tasks left
+# behind by a process that died mid-import
+IMPORT_RECHECK_SECONDS = 30
+# NOTIFY channel for new tasks and finished imports
+IMPORT_CHANNEL = "csv_import"
+
+# Advisory lock keys (pg_advisory_lock(IMPORT_LOCK_SPACE, n)): n = 0 serializes
+# claims on a node, n = task_id is held by the worker running that task
+IMPORT_LOCK_SPACE = 4521
+_CLAIM_LOCK = 0
+
+SPOOL_CHUNK_BYTES = 64 * 1024
+INSERT_BATCH_ROWS = 1000
+
+class UploadTooLarge(Exception):
+    pass
+
+class ImportQueueFull(Exception):
+    pass
+
+# ========== Spooling ==========
+
+def spool_upload(stream, max_bytes=UPLOAD_MAX_BYTES):
+    """Copy an upload stream to a spool file chunk by chunk and return its path."""
+    fd, path = tempfile.mkstemp(prefix="import_", suffix=".csv", dir=UPLOAD_SPOOL_DIR)
+    size = 0
+    try:
+        with os.fdopen(fd, "wb") as spool:
+            while True:
+                chunk = stream.read(SPOOL_CHUNK_BYTES)
+                if not chunk:
+                    break
+                size += len(chunk)
+                if size > max_bytes:
+                    raise UploadTooLarge(f"File is larger than {max_bytes // (1024 * 1024)} MB.")
+                spool.write(chunk)
+    except BaseException:
+        os.remove(path)
+        raise
+    return path
+
+# ========== Scheduler ==========
+
+class ImportScheduler:
+    """Runs queued CSV imports on a fixed set of worker threads.
+
+    The queue is the csv_import rows in each node's background_tasks table,
+    shared by every app process. A worker claims a task on a node only while
+    fewer than IMPORT_NODE_LIMIT imports are running there, takes families
+    round-robin and never runs two imports for the same family at once, so
+    one family uploading many files can't starve the others.
+
+    Each worker keeps one connection per node. A listener thread per process
+    wakes them on NOTIFY IMPORT_CHANNEL, sent when a task is queued and when
+    an import finishes.
+    """
+
+    def __init__(self, workers=IMPORT_WORKERS):
+        self.workers = workers
+        self._lock = threading.Lock()
+        self._threads = []
+        # One release per wake-up, so a notification that arrives while
+        # every worker is busy is taken up by the next one to go idle
+        self._wake = threading.Semaphore(0)
+
+    def start(self):
+        # Called per request rather than at import, so forking servers don't
+        # inherit threads; every serving process then helps drain the queue
+        with self._lock:
+            if not self._threads:
+                thread = threading.Thread(target=self._listen, name="csv-import-listener", daemon=True)
+                thread.start()
+                self._threads.append(thread)
+            while len(self._threads) <= self.workers:
+                thread = threading.Thread(target=self._work, name=f"csv-import-{len(self._threads) - 1}", daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def submit(self, family_id, user_id, path):
+        """Queue an import and return (task_id, imports queued ahead of it)."""
+        task_id, ahead = _create_task(family_id, user_id, path)
+        self.start()
+        return task_id, ahead
+
+    def _listen(self):
+        """LISTEN on every node and wake a worker per notification, or every IMPORT_RECHECK_SECONDS."""
+        conns = {}
+        while True:
+            try:
+                for node in shard_nodes():
+                    if node not in conns:
+                        conn = get_db_connection(node=node)
+                        conn.autocommit = True
+                        conn.cursor().execute(f"LISTEN {IMPORT_CHANNEL}")
+                        conns[node] = conn
+                        # Anything queued before we listened
+                        self._wake.release()
+                ready, _, _ = select.select(list(conns.values()), [], [], IMPORT_RECHECK_SECONDS)
+                if not ready:
+                    self._wake.release()
+                for conn in ready:
+                    conn.poll()
+                    for _ in conn.notifies:
+                        self._wake.release()
+                    conn.notifies.clear()
+            except Exception as e:
+                print("Error listening for CSV imports:", e)
+                for conn in conns.values():
+                    conn.close()
+                conns = {}
+                time.sleep(IMPORT_RECHECK_SECONDS)
+
+    def _work(self):
+        # One connection per node, kept for the worker's lifetime
+        conns = {}
+        while True:
+            self._wake.acquire()
+            ran = True
+            while ran:
+                ran = False
+                for node in shard_nodes():
+                    try:
+                        if node not in conns:
+                            conns[node] = get_db_connection(node=node)
+                        ran = _claim_and_run(conns[node]) or ran
+                    except Exception as e:
+                        print("Error running CSV import on", node, ":", e)
+                        # Closing also frees any locks the claim left held
+                        conn = conns.pop(node, None)
+                        if conn is not None:
+                            conn.close()
+
+scheduler = ImportScheduler()
+
+# ========== Import Tasks ==========
+
+# Kept here so benchmarks/check_plans.py checks the same SQL
+CREATE_TASK_SQL = """
+    WITH queued AS (
+        SELECT COUNT(*) AS n FROM background_tasks
+        WHERE task_name = 'csv_import' AND status = 'queued'
+    )
+    INSERT INTO background_tasks (task_name, status, family_id, user_id, spool_path)
+    SELECT 'csv_import', 'queued', %s, %s, %s FROM queued WHERE n < %s
+    RETURNING id, (SELECT n FROM queued)
+"""
+SET_RUNNING_SQL = """
+    UPDATE background_tasks SET status = %s, started_at = CURRENT_TIMESTAMP
+    WHERE id = %s
+"""
+SET_FINISHED_SQL = """
+    UPDATE background_tasks SET status = %s, detail = %s, ended_at = CURRENT_TIMESTAMP
+    WHERE id = %s
+"""
+REQUEUE_TASK_SQL = "UPDATE background_tasks SET status = 'queued' WHERE id = %s"
+RUNNING_TASKS_SQL = """
+    SELECT id, spool_path FROM background_tasks
+    WHERE task_name = 'csv_import' AND status = 'running'
+"""
+RUNNING_COUNT_SQL = """
+    SELECT COUNT(*) FROM background_tasks
+    WHERE task_name = 'csv_import' AND status = 'running'
+"""
+# Every family's oldest queued file goes before any family's second one
+NEXT_TASKS_SQL = """
+    SELECT id, family_id, user_id, spool_path FROM (
+        SELECT id, family_id, user_id, spool_path,
+               ROW_NUMBER() OVER (PARTITION BY family_id ORDER BY id) AS turn
+        FROM background_tasks t
+        WHERE task_name = 'csv_import' AND status = 'queued'
+          AND NOT EXISTS (
+              SELECT 1 FROM background_tasks r
+              WHERE r.task_name = 'csv_import' AND r.status = 'running'
+                AND r.family_id = t.family_id
+          )
+    ) queued
+    ORDER BY turn, id
+"""
+RECENT_IMPORTS_SQL = """
+    SELECT id, status, detail, started_at, ended_at
+    FROM background_tasks
+    WHERE family_id = %s AND task_name = 'csv_import'
+    ORDER BY id DESC
+    LIMIT %s
+"""
+
+def _create_task(family_id, user_id, path):
+    conn = get_db_connection(family_id)
+    cur = conn.cursor()
+    lock_family(cur, family_id)
+    cur.execute(CREATE_TASK_SQL, (family_id, user_id, path, IMPORT_QUEUE_LIMIT))
+    row = cur.fetchone()
+    if row is not None:
+        # Delivered on commit
+        cur.execute(f"NOTIFY {IMPORT_CHANNEL}")
+    conn.commit()
+    cur.close()
+    conn.close()
+    if row is None:
+        raise ImportQueueFull("The importer is busy. Please try again in a few minutes.")
+    return row
+
+def _set_task_status(cur, task_id, status, detail=None):
+    if status == 'running':
+        cur.execute(SET_RUNNING_SQL, (status, task_id))
+    else:
+        cur.execute(SET_FINISHED_SQL, (status, detail, task_id))
+
+def _recover_interrupted(cur):
+    """Requeue (or fail, if the file is gone) running tasks whose worker has died.
+
+    A live worker holds its task's advisory lock on its connection until the
+    import is recorded, so a running task whose lock is free was left behind
+    by a process that exited; its import transaction was rolled back with the
+    connection.
+    """
+    cur.execute(RUNNING_TASKS_SQL)
+    for task_id, path in cur.fetchall():
+        cur.execute("SELECT pg_try_advisory_xact_lock(%s, %s)", (IMPORT_LOCK_SPACE, task_id))
+        if not cur.fetchone()[0]:
+            continue
+        if path and os.path.exists(path):
+            cur.execute(REQUEUE_TASK_SQL, (task_id,))
+        else:
+            _set_task_status(cur, task_id, 'failed', "Import was interrupted. Please upload the file again.")
+
+def _claim(cur):
+    """Mark the next task on cur's node running and return it, or None if there is nothing to run."""
+    # Claims on a node take turns, so the running count below can't race
+    cur.execute("SELECT pg_advisory_xact_lock(%s, %s)", (IMPORT_LOCK_SPACE, _CLAIM_LOCK))
+    _recover_interrupted(cur)
+
+    cur.execute(RUNNING_COUNT_SQL)
+    if cur.fetchone()[0] >= IMPORT_NODE_LIMIT:
+        return None
+
+    cur.execute(NEXT_TASKS_SQL)
+    for job in cur.fetchall():
+        if not _hold_family(cur, job[1]):
+            continue
+        # Held until _release_claim, or until the connection closes if this
+        # process dies first; see _recover_interrupted
+        cur.execute("SELECT pg_advisory_lock(%s, %s)", (IMPORT_LOCK_SPACE, job[0]))
+        _set_task_status(cur, job[0], 'running')
+        return job
+    return None
+
+def _hold_family(cur, family_id):
+    """Hold the family's write lock (see db.lock_family) until _release_claim.
+
+    Returns False if rebalance.py is moving the family; the task then waits
+    and is claimed from the family's new node once the move is done.
+    """
+    if not is_sharded():
+        return True
+    cur.execute("SELECT pg_try_advisory_lock_shared(%s, %s)", (FAMILY_LOCK_SPACE, family_id))
+    if not cur.fetchone()[0]:
+        return False
+    if node_for_family(family_id) != cur.connection.node:
+        cur.execute("SELECT pg_advisory_unlock_shared(%s, %s)", (FAMILY_LOCK_SPACE, family_id))
+        return False
+    return True
+
+def _release_claim(cur, task_id, family_id):
+    cur.execute("SELECT pg_advisory_unlock(%s, %s)", (IMPORT_LOCK_SPACE, task_id))
+    if is_sharded():
+        cur.execute("SELECT pg_advisory_unlock_shared(%s, %s)", (FAMILY_LOCK_SPACE, family_id))
+    # A slot on the node, and the family's next file, are free again
+    cur.execute(f"NOTIFY {IMPORT_CHANNEL}")
+    cur.connection.commit()
+
+def _claim_and_run(conn):
+    """Claim and run one import on conn's node. Returns False if there was nothing to run."""
+    cur = conn.cursor()
+    try:
+        job = _claim(cur)
+        conn.commit()
+        if job is None:
+            return False
+        _run_import(conn, cur, *job)
+        _release_claim(cur, job[0], job[1])
+        return True
+    finally:
+        cur.close()
+
+def _run_import(conn, cur, task_id, family_id, user_id, path):
+    try:
+        imported = 0
+        with open(path, newline='', encoding='utf-8') as f:
+            batch = []
+            for row in csv.DictReader(f):
+                batch.append((
+                    user_id,
+                    family_id,
+                    row['category'],
+                    float(row['amount']),
+                    row['date'],
+                    row['expense_type']
+                ))
+                if len(batch) >= INSERT_BATCH_ROWS:
+                    imported += _insert_rows(cur, batch)
+                    batch = []
+            imported += _insert_rows(cur, batch)
+
+        _set_task_status(cur, task_id, 'done', f"Imported {imported} expenses.")
+        conn.commit()
+    except Exception as e:
+        conn.rollback()
+        _set_task_status(cur, task_id, 'failed', f"Error processing file: {str(e)}")
+        conn.commit()
+    # Only once the outcome is recorded; if recording it failed, the file is
+    # still there for _recover_interrupted to requeue
+    if os.path.exists(path):
+        os.remove(path)
+
+INSERT_ROWS_SQL = """
+    INSERT INTO expenses (user_id, family_id, category, amount, date, expense_type)
+    VALUES %s
+"""
+
+def _insert_rows(cur, rows):
+    if rows:
+        execute_values(cur, INSERT_ROWS_SQL, rows)
+    return len(rows)
+
+def get_recent_imports(family_id, limit=5):
+    conn = get_db_connection(family_id)
+    cur = conn.cursor()
+    cur.execute(RECENT_IMPORTS_SQL, (family_id, limit))
+    rows = cur.fetchall()
+    cur.close()
+    conn.close()
+    return rows
@@ -0,0 +1,16 @@
+-- Indexes backing every family-scoped query in app.py, admin.py and db.py.
+-- Apply to an existing database with: python db.py migrations/001_query_indexes.sql
+
+-- view_category_expenses, expense_categories, forecast_history, view_child_expenses
+CREATE INDEX IF NOT EXISTS idx_expenses_family_category_date ON expenses (family_id, category, date);
+-- forecast_changes
+CREATE INDEX IF NOT EXISTS idx_expenses_family_created_at ON expenses (family_id, created_at);
+-- export rows joined through users, and the users(id) foreign keys on delete
+CREATE INDEX IF NOT EXISTS idx_expenses_user_id ON expenses (user_id);
+CREATE INDEX IF NOT EXISTS idx_expenses_added_by ON expenses (added_by);
+
+-- sync_budget, get_budget_categories, delete_table
+CREATE INDEX IF NOT EXISTS idx_budget_family_category ON budget (family_id, category);
+
+-- family_users, family_members, delete_user
+CREATE INDEX IF NOT EXISTS idx_users_family_username ON users (family_id, username);
@@ -0,0 +1,9 @@
+-- Track queued CSV imports per family in background_tasks.
+-- Apply to an existing database with: python db.py migrations/002_import_tasks.sql
+
+ALTER TABLE background_tasks
+    ADD COLUMN IF NOT EXISTS family_id INT,
+    ADD COLUMN IF NOT EXISTS user_id INT,
+    ADD COLUMN IF NOT EXISTS detail TEXT;
+
+CREATE INDEX IF NOT EXISTS idx_background_tasks_family ON background_tasks (family_id, id);
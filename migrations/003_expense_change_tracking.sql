@@ -0,0 +1,45 @@
+-- Change tracking on expenses for the incremental admin export
+-- (admin.export_changes). Inserts and updates bump expenses.updated_at;
+-- deletes leave a row in expense_tombstones.
+-- Apply to an existing database with: python db.py migrations/003_expense_change_tracking.sql
+
+ALTER TABLE expenses ADD COLUMN IF NOT EXISTS updated_at TIMESTAMP;
+UPDATE expenses SET updated_at = COALESCE(created_at, CURRENT_TIMESTAMP) WHERE updated_at IS NULL;
+ALTER TABLE expenses
+    ALTER COLUMN updated_at SET DEFAULT CURRENT_TIMESTAMP,
+    ALTER COLUMN updated_at SET NOT NULL;
+
+CREATE TABLE IF NOT EXISTS expense_tombstones (
+    expense_id INT PRIMARY KEY,
+    family_id INT NOT NULL,
+    deleted_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE OR REPLACE FUNCTION expenses_touch_updated_at() RETURNS trigger AS $$
+BEGIN
+    NEW.updated_at := CURRENT_TIMESTAMP;
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION expenses_record_tombstone() RETURNS trigger AS $$
+BEGIN
+    INSERT INTO expense_tombstones (expense_id, family_id)
+    VALUES (OLD.id, OLD.family_id)
+    ON CONFLICT (expense_id) DO UPDATE SET deleted_at = EXCLUDED.deleted_at;
+    RETURN OLD;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS expenses_touch_updated_at ON expenses;
+CREATE TRIGGER expenses_touch_updated_at
+    BEFORE UPDATE ON expenses
+    FOR EACH ROW EXECUTE FUNCTION expenses_touch_updated_at();
+
+DROP TRIGGER IF EXISTS expenses_record_tombstone ON expenses;
+CREATE TRIGGER expenses_record_tombstone
+    AFTER DELETE ON expenses
+    FOR EACH ROW EXECUTE FUNCTION expenses_record_tombstone();
+
+CREATE INDEX IF NOT EXISTS idx_expenses_updated_at_id ON expenses (updated_at, id);
+CREATE INDEX IF NOT EXISTS idx_expense_tombstones_deleted_at ON expense_tombstones (deleted_at, expense_id);
@@ -0,0 +1,10 @@
+-- Username -> family lookup for login when families are sharded across
+-- several nodes. Apply with: python db.py migrations/004_user_directory.sql
+-- (runs on every node; only the directory node's copy is used).
+-- When first turning sharding on, seed it on the directory node with
+--   INSERT INTO user_directory SELECT username, family_id FROM users;
+
+CREATE TABLE IF NOT EXISTS user_directory (
+    username VARCHAR(50) PRIMARY KEY,
+    family_id INT NOT NULL
+);
@@ -0,0 +1,8 @@
+-- The forecast cache finds new, edited and deleted expenses by updated_at and
+-- expense_tombstones.deleted_at (db.STATEMENTS["forecast_changes"]) instead
+-- of created_at.
+-- Apply to an existing database with: python db.py migrations/005_forecast_change_indexes.sql
+
+CREATE INDEX IF NOT EXISTS idx_expenses_family_updated_at ON expenses (family_id, updated_at);
+CREATE INDEX IF NOT EXISTS idx_expense_tombstones_family_deleted_at ON expense_tombstones (family_id, deleted_at);
+DROP INDEX IF EXISTS idx_expenses_family_created_at;
@@ -0,0 +1,9 @@
+-- Queued CSV imports are claimed from background_tasks by any app process
+-- (importer.ImportScheduler), so each row records its spooled file.
+-- Apply to an existing database with: python db.py migrations/006_import_queue.sql
+
+ALTER TABLE background_tasks ADD COLUMN IF NOT EXISTS spool_path TEXT;
+
+CREATE INDEX IF NOT EXISTS idx_background_tasks_pending
+    ON background_tasks (task_name, status, family_id, id)
+    WHERE status IN ('queued', 'running');
@@ -0,0 +1,17 @@
+-- Deletes made by rebalance.py while moving a family off a node leave no
+-- tombstones: the rows live on, ids unchanged, on the target node, so the
+-- incremental export must not report them deleted. rebalance.py marks its
+-- transaction with SET LOCAL app.moving_family = 'on'.
+-- Apply to an existing database with: python db.py migrations/007_family_move_tombstones.sql
+
+CREATE OR REPLACE FUNCTION expenses_record_tombstone() RETURNS trigger AS $$
+BEGIN
+    IF current_setting('app.moving_family', true) = 'on' THEN
+        RETURN OLD;
+    END IF;
+    INSERT INTO expense_tombstones (expense_id, family_id)
+    VALUES (OLD.id, OLD.family_id)
+    ON CONFLICT (expense_id) DO UPDATE SET deleted_at = EXCLUDED.deleted_at;
+    RETURN OLD;
+END;
+$$ LANGUAGE plpgsql;
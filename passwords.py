@@ -0,0 +1,93 @@
+# passwords.py
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from werkzeug.security import generate_password_hash, check_password_hash
+
+# werkzeug method string, e.g. "scrypt:32768:8:1" or "pbkdf2:sha256:600000".
+# Changing it rehashes each user's password the next time they log in.
+PASSWORD_HASH_METHOD = os.getenv("PASSWORD_HASH_METHOD", "scrypt:32768:8:1")
+PASSWORD_HASH_WORKERS = int(os.getenv("PASSWORD_HASH_WORKERS", str(os.cpu_count() or 1)))
+# Hashes allowed in flight (running or queued) before callers wait
+PASSWORD_HASH_QUEUE_LIMIT = int(os.getenv("PASSWORD_HASH_QUEUE_LIMIT", str(PASSWORD_HASH_WORKERS * 4)))
+PASSWORD_HASH_TIMEOUT = float(os.getenv("PASSWORD_HASH_TIMEOUT", "10"))
+
+class HashingBusy(Exception):
+    pass
+
+_executor = None
+_slots = threading.BoundedSemaphore(PASSWORD_HASH_QUEUE_LIMIT)
+_lock = threading.Lock()
+_method_prefix = None
+
+# ========== Pool ==========
+
+def _get_executor():
+    global _executor
+    with _lock:
+        if _executor is None:
+            # spawn: the app process has DB pools and worker threads that
+            # must not be forked into the hashing processes
+            _executor = ProcessPoolExecutor(
+                max_workers=PASSWORD_HASH_WORKERS,
+                mp_context=multiprocessing.get_context("spawn")
+            )
+        return _executor
+
+def _drop_executor(broken):
+    # A hashing process that died (OOM kill, segfault) breaks its whole pool
+    # for good; the next _get_executor starts a new one
+    global _executor
+    with _lock:
+        if _executor is broken:
+            _executor = None
+    broken.shutdown(wait=False)
+
+def _run(fn, *args):
+    """Run fn in the hashing pool, waiting at most PASSWORD_HASH_TIMEOUT for a slot."""
+    if not _slots.acquire(timeout=PASSWORD_HASH_TIMEOUT):
+        raise HashingBusy("Too many logins at once. Please try again.")
+    try:
+        for attempt in range(2):
+            executor = _get_executor()
+            try:
+                return executor.submit(fn, *args).result()
+            except BrokenProcessPool:
+                _drop_executor(executor)
+                if attempt:
+                    raise
+    finally:
+        _slots.release()
+
+def _current_prefix():
+    # "scrypt" or "pbkdf2:sha256" come back with their defaults filled in, so
+    # read the stored form off a real hash once
+    global _method_prefix
+    if _method_prefix is None:
+        _method_prefix = _run(generate_password_hash, "", PASSWORD_HASH_METHOD).split("$", 1)[0]
+    return _method_prefix
+
+# ========== Worker Functions ==========
+
+def _verify_and_rehash(stored_hash, password, method, prefix):
+    if not check_password_hash(stored_hash, password):
+        return False, None
+    if stored_hash.split("$", 1)[0] != prefix:
+        return True, generate_password_hash(password, method)
+    return True, None
+
+# ========== Public API ==========
+
+def hash_password(password):
+    return _run(generate_password_hash, password, PASSWORD_HASH_METHOD)
+
+def verify_password(stored_hash, password):
+    """Check a password off-thread.
+
+    Returns (matches, new_hash). new_hash is set when the password matched
+    but was stored with different hash parameters and should be replaced.
+    """
+    return _run(_verify_and_rehash, stored_hash, password, PASSWORD_HASH_METHOD, _current_prefix())
@@ -0,0 +1,226 @@
+# rebalance.py
+#
+# Moves one family's rows (users, budget, expenses, background_tasks) to
+# another shard node and pins the family there in the SHARD_MAP file.
+# Running app processes pick up the new map on their next query.
+#
+# Rows keep their ids, so signed-in sessions and open pages stay valid. That
+# relies on every node handing out ids from its own block: give each node an
+# "id_block" in the map and run assign-id-blocks once, and again after adding
+# a node.
+#
+# Only the moving family's writes wait: the move holds its write lock
+# (db.lock_family) on the source, and writers that were waiting on it redo
+# their write on the target once the map has switched.
+#
+# The move is recorded under "moves" in the map until the source is cleaned
+# up, so if it is interrupted, running the same command again finishes it.
+#
+# Usage:
+#   python rebalance.py assign-id-blocks
+#   python rebalance.py <family_id> <target_node>
+import fcntl
+import json
+import os
+import sys
+import tempfile
+
+from psycopg2.extras import execute_values
+
+from db import FAMILY_LOCK_SPACE, SHARD_MAP, get_db_connection, get_shard_map, node_for_family, shard_nodes
+
+# Ids per node; SERIAL columns top out at 2^31 - 1, so blocks 0-20 fit
+ID_BLOCK_SIZE = 100_000_000
+
+# Parent tables first, so foreign keys hold while copying
+FAMILY_TABLES = [
+    ("users", ["id", "username", "password", "role", "family_id", "created_at"]),
+    ("budget", ["id", "family_id", "category", "amount", "created_at"]),
+    # updated_at is left to default to now, so incremental exports that are
+    # already past the original timestamps still see the rows arrive here
+    ("expenses", ["id", "user_id", "family_id", "category", "amount", "date",
+                  "expense_type", "added_by", "created_at"]),
+    ("background_tasks", ["id", "task_name", "status", "started_at", "ended_at",
+                          "family_id", "user_id", "detail", "spool_path"]),
+]
+
+# ========== Id Blocks ==========
+
+def id_block_range(node):
+    block = get_shard_map()["id_blocks"].get(node)
+    if block is None:
+        sys.exit(f"Node {node!r} has no id_block in {SHARD_MAP}")
+    return block * ID_BLOCK_SIZE + 1, (block + 1) * ID_BLOCK_SIZE
+
+def id_sequences(cur):
+    for table, _ in FAMILY_TABLES:
+        cur.execute("SELECT pg_get_serial_sequence(%s, 'id')", (table,))
+        yield table, cur.fetchone()[0]
+
+def assign_id_blocks():
+    """Point every node's id sequences at that node's block."""
+    for node in shard_nodes():
+        low, high = id_block_range(node)
+        conn = get_db_connection(node=node)
+        cur = conn.cursor()
+        for table, sequence in list(id_sequences(cur)):
+            cur.execute(f"SELECT MAX(id) FROM {table} WHERE id BETWEEN %s AND %s", (low, high))
+            restart = max(low, (cur.fetchone()[0] or 0) + 1)
+            cur.execute(f"ALTER SEQUENCE {sequence} MINVALUE {low} MAXVALUE {high} START WITH {low} RESTART WITH {restart}")
+        conn.commit()
+        cur.close()
+        conn.close()
+        print(f"{node}: ids {low}-{high}")
+
+def check_id_blocks(node):
+    low, high = id_block_range(node)
+    conn = get_db_connection(node=node)
+    cur = conn.cursor()
+    for table, sequence in list(id_sequences(cur)):
+        cur.execute("SELECT seqmin, seqmax FROM pg_sequence WHERE seqrelid = %s::regclass", (sequence,))
+        if cur.fetchone() != (low, high):
+            sys.exit(f"{node}.{table} ids aren't limited to the node's block; run: python rebalance.py assign-id-blocks")
+    cur.close()
+    conn.close()
+
+# ========== Copying ==========
+
+def copy_family(src_cur, dst_cur, family_id):
+    """Copy the family's rows, ids included, from source to target; returns rows copied."""
+    copied = 0
+    for table, columns in FAMILY_TABLES:
+        column_list = ", ".join(columns)
+        src_cur.execute(f"SELECT {column_list} FROM {table} WHERE family_id = %s", (family_id,))
+        rows = src_cur.fetchall()
+        if rows:
+            execute_values(dst_cur, f"INSERT INTO {table} ({column_list}) VALUES %s", rows, page_size=1000)
+            copied += len(rows)
+    return copied
+
+def delete_family(cur, family_id):
+    # The rows live on under the same ids on the other node, so keep the
+    # tombstone trigger from reporting them deleted to incremental exports
+    cur.execute("SET LOCAL app.moving_family = 'on'")
+    cur.execute("DELETE FROM expenses WHERE family_id = %s", (family_id,))
+    cur.execute("DELETE FROM budget WHERE family_id = %s", (family_id,))
+    cur.execute("DELETE FROM background_tasks WHERE family_id = %s", (family_id,))
+    cur.execute("DELETE FROM users WHERE family_id = %s", (family_id,))
+
+def run_on_node(node, family_id, fn):
+    """Call fn(cur) in one transaction on node while holding family_id's write lock there."""
+    conn = get_db_connection(node=node)
+    cur = conn.cursor()
+    try:
+        # Waits for the family's in-flight writes and running imports, then
+        # holds off new ones until commit
+        cur.execute("SELECT pg_advisory_xact_lock(%s, %s)", (FAMILY_LOCK_SPACE, family_id))
+        result = fn(cur)
+        conn.commit()
+        return result
+    finally:
+        cur.close()
+        conn.close()
+
+def move_pass(source, target, family_id):
+    def copy_and_switch(src_cur):
+        dst = get_db_connection(node=target)
+        dst_cur = dst.cursor()
+        try:
+            copied = copy_family(src_cur, dst_cur, family_id)
+            dst.commit()
+        finally:
+            dst_cur.close()
+            dst.close()
+        pin_family(family_id, target)
+        delete_family(src_cur, family_id)
+        return copied
+    return run_on_node(source, family_id, copy_and_switch)
+
+# ========== Shard Map ==========
+
+def update_shard_map(change):
+    # Moves of different families can run at once; the lock keeps one from
+    # writing back a map read before another's change
+    with open(SHARD_MAP + ".lock", "a") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        with open(SHARD_MAP) as f:
+            raw = json.load(f)
+        change(raw)
+
+        # Write and rename so app processes never read a half-written map
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(SHARD_MAP)), suffix=".tmp")
+        try:
+            # mkstemp makes the file owner-only; keep the map readable as before
+            os.fchmod(fd, os.stat(SHARD_MAP).st_mode & 0o777)
+            with os.fdopen(fd, "w") as f:
+                json.dump(raw, f, indent=2)
+                f.write("\n")
+            os.replace(tmp_path, SHARD_MAP)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+def pin_family(family_id, node):
+    def pin(raw):
+        raw.setdefault("families", {})[str(family_id)] = node
+    update_shard_map(pin)
+
+def record_move(family_id, move):
+    """Record {"from": ..., "to": ...} for a move in progress, or clear it with None."""
+    def record(raw):
+        moves = raw.setdefault("moves", {})
+        if move:
+            moves[str(family_id)] = move
+        else:
+            moves.pop(str(family_id), None)
+        if not moves:
+            del raw["moves"]
+    update_shard_map(record)
+
+def pending_move(family_id):
+    with open(SHARD_MAP) as f:
+        return json.load(f).get("moves", {}).get(str(family_id))
+
+# ========== Moving ==========
+
+def move_family(family_id, target):
+    if target not in shard_nodes():
+        sys.exit(f"Unknown node {target!r}; nodes are {', '.join(shard_nodes())}")
+
+    move = pending_move(family_id)
+    if move:
+        source = move["from"]
+        if move["to"] != target:
+            sys.exit(f"Family {family_id} is partway through a move to {move['to']}; rerun with that node to finish it")
+        if node_for_family(family_id) == target:
+            # The map switched before the source was cleaned up. Writes have
+            # gone to the target since, so the source copy is only dropped.
+            run_on_node(source, family_id, lambda cur: delete_family(cur, family_id))
+            record_move(family_id, None)
+            print(f"Finished moving family {family_id} to {target}; removed its old rows from {source}")
+            return
+        # The map never switched, so the source is still current; drop the
+        # partial copy and start over
+        run_on_node(target, family_id, lambda cur: delete_family(cur, family_id))
+    else:
+        source = node_for_family(family_id)
+        if source == target:
+            print(f"Family {family_id} is already on {target}")
+            return
+        check_id_blocks(source)
+        check_id_blocks(target)
+        record_move(family_id, {"from": source, "to": target})
+
+    copied = move_pass(source, target, family_id)
+    record_move(family_id, None)
+    print(f"Moved family {family_id} from {source} to {target}: {copied} rows")
+
+if __name__ == '__main__':
+    if not SHARD_MAP:
+        sys.exit("SHARD_MAP is not set; there is only one node.")
+    if sys.argv[1:] == ["assign-id-blocks"]:
+        assign_id_blocks()
+    elif len(sys.argv) == 3:
+        move_family(int(sys.argv[1]), sys.argv[2])
+    else:
+        sys.exit("usage: python rebalance.py assign-id-blocks | <family_id> <target_node>")
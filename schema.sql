@@ -1,6 +1,6 @@
 -- Drop enum and tables if they already exist
 DROP TYPE IF EXISTS family_role CASCADE;
-DROP TABLE IF EXISTS background_tasks, expenses, budget, users CASCADE;
+DROP TABLE IF EXISTS background_tasks, expense_tombstones, expenses, budget, user_directory, users CASCADE;
 
 -- Create enum for user roles
 CREATE TYPE family_role AS ENUM ('parent', 'child');
@@ -15,6 +15,13 @@ CREATE TABLE users (
     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
 );
 
+-- Username -> family lookup for login when families are sharded across
+-- several nodes (see db.py). Only used on the shard map's directory node.
+CREATE TABLE user_directory (
+    username VARCHAR(50) PRIMARY KEY,
+    family_id INT NOT NULL
+);
+
 -- Budget table
 CREATE TABLE budget (
     id SERIAL PRIMARY KEY,
@@ -34,14 +41,70 @@ CREATE TABLE expenses (
     date DATE,                                             -- from CSV or manual input
     expense_type VARCHAR(100),                             -- from CSV or manual input
     added_by INT REFERENCES users(id) ON DELETE SET NULL,  -- who submitted the expense
-    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    updated_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP -- bumped by trigger, drives the incremental export
 );
 
+-- Deleted expenses, kept so the incremental export can report deletes
+CREATE TABLE expense_tombstones (
+    expense_id INT PRIMARY KEY,
+    family_id INT NOT NULL,
+    deleted_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE OR REPLACE FUNCTION expenses_touch_updated_at() RETURNS trigger AS $$
+BEGIN
+    NEW.updated_at := CURRENT_TIMESTAMP;
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+-- rebalance.py's deletes while moving a family off a node leave no tombstone
+CREATE OR REPLACE FUNCTION expenses_record_tombstone() RETURNS trigger AS $$
+BEGIN
+    IF current_setting('app.moving_family', true) = 'on' THEN
+        RETURN OLD;
+    END IF;
+    INSERT INTO expense_tombstones (expense_id, family_id)
+    VALUES (OLD.id, OLD.family_id)
+    ON CONFLICT (expense_id) DO UPDATE SET deleted_at = EXCLUDED.deleted_at;
+    RETURN OLD;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER expenses_touch_updated_at
+    BEFORE UPDATE ON expenses
+    FOR EACH ROW EXECUTE FUNCTION expenses_touch_updated_at();
+
+CREATE TRIGGER expenses_record_tombstone
+    AFTER DELETE ON expenses
+    FOR EACH ROW EXECUTE FUNCTION expenses_record_tombstone();
+
+-- Indexes for the family-scoped queries (see migrations/001_query_indexes.sql)
+CREATE INDEX idx_expenses_family_category_date ON expenses (family_id, category, date);
+CREATE INDEX idx_expenses_family_updated_at ON expenses (family_id, updated_at);
+CREATE INDEX idx_expenses_user_id ON expenses (user_id);
+CREATE INDEX idx_expenses_added_by ON expenses (added_by);
+CREATE INDEX idx_budget_family_category ON budget (family_id, category);
+CREATE INDEX idx_users_family_username ON users (family_id, username);
+CREATE INDEX idx_expenses_updated_at_id ON expenses (updated_at, id);
+CREATE INDEX idx_expense_tombstones_deleted_at ON expense_tombstones (deleted_at, expense_id);
+CREATE INDEX idx_expense_tombstones_family_deleted_at ON expense_tombstones (family_id, deleted_at);
+
 -- Background tasks table (optional for async or scheduled work)
 CREATE TABLE background_tasks (
     id SERIAL PRIMARY KEY,
     task_name VARCHAR(100),
     status TEXT CHECK (status IN ('queued', 'running', 'done', 'failed')),
     started_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-    ended_at TIMESTAMP
-);
\ No newline at end of file
+    ended_at TIMESTAMP,
+    family_id INT,                                         -- family that queued the task
+    user_id INT,                                           -- user that queued the task
+    detail TEXT,                                           -- result or error message
+    spool_path TEXT                                        -- queued CSV file for csv_import tasks
+);
+
+CREATE INDEX idx_background_tasks_family ON background_tasks (family_id, id);
+CREATE INDEX idx_background_tasks_pending
+    ON background_tasks (task_name, status, family_id, id)
+    WHERE status IN ('queued', 'running');
\ No newline at end of file
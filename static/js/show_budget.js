@@ -86,4 +86,51 @@ document.addEventListener("DOMContentLoaded", async () => {
         container.innerHTML = `<p class="text-red-500 text-center font-semibold">Failed to load table</p>`;
         console.error(" Fetch error:", err);
     }
-});
\ No newline at end of file
+
+    await showForecast(document.getElementById('forecastContainer'));
+});
+
+// Render projected month-end spend, highlighting categories headed over budget
+async function showForecast(container) {
+    if (!container) return;
+
+    try {
+        const res = await fetch(container.dataset.forecastUrl, { method: 'POST' });
+        const data = await res.json();
+
+        if (!data.success) {
+            container.innerHTML = `<p class="text-red-500 font-semibold text-center">${data.error}</p>`;
+            return;
+        }
+
+        const table = document.createElement('table');
+        table.className = 'min-w-full table-auto border border-gray-300 shadow-md rounded overflow-hidden';
+
+        const headerRow = table.createTHead().insertRow();
+        data.column_names.forEach(col => {
+            const th = document.createElement('th');
+            th.textContent = col;
+            th.className = 'px-4 py-2 bg-green-700 text-white text-left font-semibold border-b';
+            headerRow.appendChild(th);
+        });
+
+        const tbody = table.createTBody();
+        data.table_data.forEach(row => {
+            const tr = tbody.insertRow();
+            tr.className = row.over_budget ? 'bg-red-100' : 'bg-gray-50';
+            if (row.over_budget) tr.title = 'Projected to exceed this budget';
+
+            data.column_names.forEach(col => {
+                const td = tr.insertCell();
+                td.textContent = row[col];
+                td.className = 'px-4 py-2 border ' + (row.over_budget ? 'text-red-700 font-semibold' : 'text-gray-800');
+            });
+        });
+
+        container.innerHTML = '';
+        container.appendChild(table);
+    } catch (err) {
+        container.innerHTML = `<p class="text-red-500 text-center font-semibold">Failed to load forecast</p>`;
+        console.error(" Forecast fetch error:", err);
+    }
+}
\ No newline at end of file
@@ -19,6 +19,13 @@ document.addEventListener("DOMContentLoaded", () => {
             return;
         }
 
+        const maxBytes = parseInt(form.dataset.maxBytes, 10);
+        if (maxBytes && file.size > maxBytes) {
+            alert(`File is too large. The limit is ${Math.floor(maxBytes / (1024 * 1024))} MB.`);
+            e.preventDefault();
+            return;
+        }
+
         // Optional cosmetic feedback
         alert("Uploading file...");
     });